@@ -0,0 +1,204 @@
+"""Actuator command engine.
+
+Each actuator keeps the state the UI asked for (desired) apart from the
+state the device confirmed on its ack topic (reported). An ack that answers
+no command of ours (retained, after a reboot, a switch on the board) moves
+desired along with it, so "state" always matches the device. Commands are not
+published straight from the HTTP handler: a toggle only flips `desired` and
+the engine thread publishes once the value has been quiet for
+COALESCE_WINDOW, so a burst of clicks ends up as one command carrying the
+final state (or none, if the clicks cancel out). Unacked commands are
+re-sent with QoS 1 until RETRIES runs out.
+"""
+import threading
+import time
+
+import applog
+import metrics
+
+COALESCE_WINDOW = 0.15  # seconds of quiet before a command is sent
+ACK_TIMEOUT = 2.0
+RETRIES = 3
+QOS = 1
+
+log = applog.get_logger("actuators")
+
+COMMANDS = metrics.counter("actuator_commands_total", "Actuator commands by outcome", ("actuator", "kind"))
+ACK_LATENCY = metrics.histogram("actuator_ack_seconds", "Command publish to device ack", ("actuator",),
+                                buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0))
+
+
+class Actuator:
+    def __init__(self, name, req_topic, resp_topic, initial=None, active_low=False):
+        self.name = name
+        self.req_topic = req_topic
+        self.resp_topic = resp_topic
+        self.active_low = active_low
+        self.desired = initial if initial is not None else 0
+        self.reported = initial   # None until the device tells us
+        self.changed_at = 0.0     # last time desired changed
+        self.sent_value = None    # value of the command in flight
+        self.sent_at = None
+        self.attempts = 0
+        self.requested = False    # nothing is sent until someone asks
+        self.failed = False
+        self.version = 0
+
+    def wire(self, value):
+        return 1 - value if self.active_low else value
+
+    def pending(self):
+        return self.requested and self.reported != self.desired and not self.failed
+
+    def as_dict(self):
+        return {
+            "state": self.desired,
+            "desired": self.desired,
+            "reported": self.reported,
+            "pending": self.pending(),
+            "failed": self.failed,
+            "version": self.version,
+        }
+
+
+class ActuatorEngine:
+    def __init__(self, publish, actuators):
+        self.publish = publish  # publish(topic, payload, qos)
+        self.actuators = {a.name: a for a in actuators}
+        self.by_topic = {a.resp_topic: a for a in actuators}
+        self.cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="actuators")
+            self._thread.start()
+
+    # ---------- commands ----------
+
+    def set(self, name, value, immediate=False):
+        # immediate: automation, not a click; send without waiting for the burst to settle
+        act = self.actuators[name]
+        with self.cond:
+            if value != act.desired or act.failed:
+                now = time.time()
+                if act.changed_at and now - act.changed_at < COALESCE_WINDOW:
+                    COMMANDS.inc(name, "coalesced")
+                act.desired = value
+                act.changed_at = now - COALESCE_WINDOW if immediate else now
+                act.requested = True
+                act.failed = False
+                act.attempts = 0
+                act.version += 1
+                self.cond.notify_all()
+            return act.as_dict()
+
+    def toggle(self, name):
+        with self.cond:
+            return self.set(name, 0 if self.actuators[name].desired else 1)
+
+    def state(self, name=None):
+        with self.cond:
+            if name is not None:
+                return self.actuators[name].as_dict()
+            return {n: a.as_dict() for n, a in self.actuators.items()}
+
+    def wait(self, timeout, version=None):
+        # Block until nothing is pending (or something changed past `version`).
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                settled = not any(a.pending() for a in self.actuators.values())
+                moved = version is not None and sum(a.version for a in self.actuators.values()) > version
+                remaining = deadline - time.time()
+                if settled or moved or remaining <= 0:
+                    return {n: a.as_dict() for n, a in self.actuators.items()}
+                self.cond.wait(remaining)
+
+    # ---------- acks ----------
+
+    def handles(self, topic):
+        return topic in self.by_topic
+
+    def on_ack(self, topic, payload):
+        # -> the reported value (0 / 1), or None for a malformed ack or a topic
+        # that isn't an actuator's (see handles())
+        act = self.by_topic.get(topic)
+        if act is None:
+            return None
+        try:
+            value = act.wire(int(payload.decode().strip()))
+        except (ValueError, UnicodeDecodeError):
+            applog.warning(log, "bad ack", topic=topic, payload=payload)
+            return None
+        with self.cond:
+            if act.sent_at is not None and value == act.sent_value:
+                ACK_LATENCY.observe(time.time() - act.sent_at, act.name)
+            if act.reported != value:
+                act.version += 1
+            if not act.pending():
+                # nothing of ours in flight (retained ack, reboot, switch on
+                # the board): the device's state is the state
+                act.desired = value
+            act.reported = value
+            if value == act.sent_value:
+                act.sent_value = None
+                act.sent_at = None
+            if value == act.desired:
+                act.failed = False
+                act.attempts = 0
+            self.cond.notify_all()
+        applog.debug(log, "ack", topic=topic, actuator=act.name, reported=value)
+        return value
+
+    # ---------- engine ----------
+
+    def _due(self, act, now):
+        # returns seconds until this actuator needs attention, 0 = now, None = idle
+        if not act.requested or act.failed or act.desired == act.reported and act.sent_value is None:
+            return None
+        quiet = act.changed_at + COALESCE_WINDOW - now
+        if quiet > 0:
+            return quiet
+        if act.sent_value != act.desired:
+            return 0
+        return max(0.0, act.sent_at + ACK_TIMEOUT - now)
+
+    def _run(self):
+        while True:
+            sends = []
+            with self.cond:
+                now = time.time()
+                wait = None
+                for act in self.actuators.values():
+                    due = self._due(act, now)
+                    if due is None:
+                        continue
+                    if due > 0:
+                        wait = due if wait is None else min(wait, due)
+                        continue
+                    if act.desired == act.reported:
+                        # desired went back to what the device already has
+                        act.sent_value = None
+                        act.sent_at = None
+                        continue
+                    if act.attempts > RETRIES:
+                        act.failed = True
+                        act.sent_value = None
+                        COMMANDS.inc(act.name, "failed")
+                        applog.warning(log, "no ack", actuator=act.name, desired=act.desired)
+                        self.cond.notify_all()
+                        continue
+                    kind = "retry" if act.sent_value == act.desired else "send"
+                    act.sent_value = act.desired
+                    act.sent_at = now
+                    act.attempts += 1
+                    sends.append((act, act.sent_value, kind))
+                    wait = ACK_TIMEOUT if wait is None else min(wait, ACK_TIMEOUT)
+                if not sends:
+                    self.cond.wait(wait)
+                    continue
+            for act, value, kind in sends:
+                COMMANDS.inc(act.name, kind)
+                applog.info(log, "command", topic=act.req_topic, actuator=act.name, state=value, kind=kind)
+                self.publish(act.req_topic, str(act.wire(value)), QOS)
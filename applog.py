@@ -0,0 +1,151 @@
+"""Structured logging that never blocks the MQTT network thread.
+
+Records are handed to a bounded queue and formatted/written by a background
+listener thread. Callers gate on the level before building anything, and a
+per-topic token bucket keeps a chatty topic from flooding the queue.
+
+    log = applog.get_logger("mqtt")
+    applog.debug(log, "message", topic=topic, size=len(payload))
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+QUEUE_SIZE = 10000
+TOPIC_RATE = 5.0     # records per second per topic
+TOPIC_BURST = 20
+
+_listener = None
+_setup_lock = threading.Lock()
+dropped = 0
+
+
+class _DropQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats in the caller's thread and blocks or
+    # raises when the queue is full. Here the caller only enqueues.
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class TopicRateLimit(logging.Filter):
+    def __init__(self, rate=TOPIC_RATE, burst=TOPIC_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # topic -> [tokens, last]
+
+    def filter(self, record):
+        topic = getattr(record, "topic", None)
+        if topic is None:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(topic)
+        if bucket is None:
+            bucket = self._buckets[topic] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, fmt="text"):
+        super().__init__()
+        self.json = fmt == "json"
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+        msg = record.getMessage()
+        if self.json:
+            out = {"ts": ts, "level": record.levelname, "logger": record.name, "msg": msg}
+            out.update(fields)
+            if record.exc_text:
+                out["exc"] = record.exc_text
+            return json.dumps(out, default=str)
+        parts = [ts, record.levelname, record.name, msg]
+        parts.extend(f"{k}={v}" for k, v in fields.items())
+        line = " ".join(str(p) for p in parts)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+def setup(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        q = queue.Queue(QUEUE_SIZE)
+        out = logging.StreamHandler(stream)
+        out.setFormatter(StructuredFormatter(fmt))
+        _listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+        _listener.start()
+
+        handler = _DropQueueHandler(q)
+        handler.addFilter(TopicRateLimit())
+        root = logging.getLogger("app")
+        root.handlers[:] = [handler]
+        root.setLevel(level)
+        root.propagate = False
+        atexit.register(shutdown)
+
+
+def shutdown():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name):
+    setup()
+    return logging.getLogger(f"app.{name}")
+
+
+def _log(log, level, msg, fields):
+    if not log.isEnabledFor(level):
+        return
+    extra = {"fields": fields}
+    if "topic" in fields:
+        extra["topic"] = fields["topic"]
+    log.log(level, msg, extra=extra)
+
+
+def debug(log, msg, **fields):
+    if log.isEnabledFor(logging.DEBUG):
+        _log(log, logging.DEBUG, msg, fields)
+
+
+def info(log, msg, **fields):
+    _log(log, logging.INFO, msg, fields)
+
+
+def warning(log, msg, **fields):
+    _log(log, logging.WARNING, msg, fields)
+
+
+def error(log, msg, **fields):
+    _log(log, logging.ERROR, msg, fields)
@@ -0,0 +1,97 @@
+"""Tag camera frames as changed / unchanged.
+
+Each frame is decoded straight to a small grayscale image (libjpeg can do
+1/8 scale while decoding, which costs a fraction of a full decode), pooled
+to THUMB_SIZE and compared with the last frame that counted as changed.
+The score is the mean absolute difference in gray levels (0-255).
+
+Comparing against the last *changed* frame instead of the previous frame
+means a slow drift (daylight, plants growing) still trips the threshold
+eventually. A frame is also always treated as changed after
+KEYFRAME_INTERVAL, so downstream stages get a fresh frame now and then.
+"""
+import hashlib
+import time
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+    from PIL import Image
+    import io
+
+import metrics
+
+THUMB_SIZE = (32, 24)      # width, height
+THRESHOLD = 4.0            # mean abs gray-level difference
+KEYFRAME_INTERVAL = 600    # seconds
+
+FRAMES = metrics.counter("change_detect_frames_total", "Frames by change detection result", ("camera", "result"))
+DETECT_TIME = metrics.histogram("change_detect_seconds", "Decode + compare time per frame")
+
+
+def thumbnail(payload):
+    # -> float32 array of THUMB_SIZE[::-1], or None if the JPEG can't be decoded
+    if cv2 is not None:
+        img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    else:
+        try:
+            pil = Image.open(io.BytesIO(payload))
+            pil.draft("L", (pil.width // 8, pil.height // 8))
+            img = np.asarray(pil.convert("L"))
+        except (OSError, ValueError):
+            # truncated / corrupt JPEG: Pillow raises where imdecode returns None
+            return None
+    if img is None or img.size == 0:
+        return None
+    return pool(img.astype(np.float32), THUMB_SIZE)
+
+
+def pool(img, size):
+    # area-average down to size; crops the few edge pixels that don't divide
+    w, h = size
+    fy, fx = max(1, img.shape[0] // h), max(1, img.shape[1] // w)
+    img = img[:fy * h, :fx * w]
+    if img.shape[0] < h or img.shape[1] < w:
+        return img
+    return img.reshape(h, fy, w, fx).mean(axis=(1, 3))
+
+
+def score(a, b):
+    if a.shape != b.shape:
+        return float("inf")
+    return float(np.abs(a - b).mean())
+
+
+class ChangeDetector:
+    def __init__(self, threshold=THRESHOLD, keyframe_interval=KEYFRAME_INTERVAL):
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self._ref = {}  # key -> (thumbnail, digest, time)
+
+    def check(self, key, payload, now=None):
+        """Returns (changed, score). Undecodable frames count as changed."""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        digest = hashlib.blake2b(payload, digest_size=16).digest()
+        ref = self._ref.get(key)
+        if ref is not None and ref[1] == digest and now - ref[2] < self.keyframe_interval:
+            return self._result(key, False, 0.0, start)
+        thumb = thumbnail(payload)
+        if thumb is None:
+            return self._result(key, True, float("inf"), start)
+        if ref is None:
+            self._ref[key] = (thumb, digest, now)
+            return self._result(key, True, float("inf"), start)
+        s = score(thumb, ref[0])
+        changed = s >= self.threshold or now - ref[2] >= self.keyframe_interval
+        if changed:
+            self._ref[key] = (thumb, digest, now)
+        return self._result(key, changed, s, start)
+
+    def _result(self, key, changed, s, start):
+        DETECT_TIME.observe(time.perf_counter() - start)
+        FRAMES.inc(key, "changed" if changed else "unchanged")
+        return changed, s
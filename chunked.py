@@ -0,0 +1,134 @@
+"""Receiver side of the chunked picture protocol.
+
+A camera may send a frame as one MQTT message (a plain JPEG, as before) or
+as several chunks on the same topic. Each chunk starts with a header:
+
+    "<4sIHHIII"  b"FCH1", frame id, chunk index, chunk count,
+                 byte offset of this chunk, total frame size, CRC-32 of the frame
+
+followed by the chunk bytes. JPEG data always starts with FF D8, so the
+magic can't be mistaken for a single-message frame.
+
+Chunks are copied into a buffer preallocated from the total size and may
+arrive in any order or more than once. A frame is returned once every
+chunk is in and the CRC matches; frames still incomplete after TIMEOUT
+seconds are discarded. At most MAX_PARTIALS frames per key are assembled
+at once: the first chunk of a newer frame evicts the oldest unfinished
+one, so a burst of frame ids can't pile up MAX_FRAME-sized buffers.
+"""
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+
+MAGIC = b"FCH1"
+HEADER = struct.Struct("<4sIHHIII")
+TIMEOUT = 5.0
+MAX_FRAME = 4 * 1024 * 1024
+MAX_PARTIALS = 2     # unfinished frames per key
+
+FRAMES = metrics.counter("chunked_frames_total", "Frames by reassembly outcome", ("outcome",))
+
+
+class _Partial:
+    __slots__ = ("buf", "count", "crc", "seen", "missing", "started")
+
+    def __init__(self, total, count, crc, now):
+        self.buf = bytearray(total)
+        self.count = count
+        self.crc = crc
+        self.seen = bytearray(count)
+        self.missing = count
+        self.started = now
+
+
+def is_chunk(payload):
+    return payload[:4] == MAGIC
+
+
+def make_chunks(frame_id, frame, chunk_size):
+    """Sender side: what a camera publishes, e.g. to simulate one."""
+    crc = zlib.crc32(frame)
+    count = max(1, (len(frame) + chunk_size - 1) // chunk_size)
+    return [HEADER.pack(MAGIC, frame_id, i, count, i * chunk_size, len(frame), crc)
+            + frame[i * chunk_size:(i + 1) * chunk_size] for i in range(count)]
+
+
+class Reassembler:
+    def __init__(self, timeout=TIMEOUT, max_frame=MAX_FRAME, max_partials=MAX_PARTIALS):
+        self.timeout = timeout
+        self.max_frame = max_frame
+        self.max_partials = max_partials
+        self._partials = {}  # (key, frame id) -> _Partial
+        self._open = {}      # key -> [frame id, ...] of its partials, oldest first
+        self._done = {}      # (key, frame id) -> finish time, to drop late duplicates
+        self._lock = threading.Lock()
+        self._next_expiry = 0.0
+
+    def feed(self, key, payload, now=None):
+        """Returns the complete frame (bytes) or None while chunks are missing."""
+        if payload[:4] != MAGIC:
+            FRAMES.inc("single")
+            return payload
+        if len(payload) < HEADER.size:
+            FRAMES.inc("bad_chunk")
+            return None
+        now = time.monotonic() if now is None else now
+        _, frame_id, index, count, offset, total, crc = HEADER.unpack_from(payload)
+        data = memoryview(payload)[HEADER.size:]
+        if not count or index >= count or total > self.max_frame or offset + len(data) > total:
+            FRAMES.inc("bad_chunk")
+            return None
+
+        with self._lock:
+            if now >= self._next_expiry:
+                self._expire(now)
+            part = self._partials.get((key, frame_id))
+            if part is None:
+                if (key, frame_id) in self._done:
+                    return None
+                open_ids = self._open.setdefault(key, [])
+                while len(open_ids) >= self.max_partials:
+                    del self._partials[(key, open_ids.pop(0))]
+                    FRAMES.inc("evicted")
+                open_ids.append(frame_id)
+                part = self._partials[(key, frame_id)] = _Partial(total, count, crc, now)
+            elif part.count != count or len(part.buf) != total or part.crc != crc:
+                FRAMES.inc("bad_chunk")
+                return None
+            if part.seen[index]:
+                return None
+            part.buf[offset:offset + len(data)] = data
+            part.seen[index] = 1
+            part.missing -= 1
+            if part.missing:
+                return None
+            del self._partials[(key, frame_id)]
+            self._forget(key, frame_id)
+            self._done[(key, frame_id)] = now
+
+        if zlib.crc32(part.buf) != part.crc:
+            FRAMES.inc("corrupt")
+            return None
+        FRAMES.inc("reassembled")
+        return bytes(part.buf)
+
+    def _expire(self, now):
+        for k, part in list(self._partials.items()):
+            if now - part.started > self.timeout:
+                del self._partials[k]
+                self._forget(*k)
+                FRAMES.inc("expired")
+        for k, done in list(self._done.items()):
+            if now - done > self.timeout:
+                del self._done[k]
+        self._next_expiry = now + min(1.0, self.timeout)
+
+    def _forget(self, key, frame_id):
+        open_ids = self._open.get(key)
+        if open_ids is not None:
+            open_ids.remove(frame_id)
+            if not open_ids:
+                del self._open[key]
@@ -0,0 +1,203 @@
+"""Per-device latency and reliability statistics over sliding windows.
+
+For every (device, kind) pair, e.g. ("ESP32_CAM_1", "heartbeat"), the engine
+tracks request->response RTT, answered vs. timed-out requests, jitter (mean
+absolute difference between consecutive RTTs) and, for frames, payload
+sizes.
+
+Values go into log-bucketed histograms (HDR style: each bucket is GROWTH
+wider than the previous one, so any quantile is within ~2% of the true
+value) that are sparse dicts and cheap to merge. Time is cut into slices;
+a window query merges the slices it covers, and slices older than the
+longest window are dropped.
+"""
+import math
+import threading
+import time
+
+GROWTH = 1.04
+_LOG_GROWTH = math.log(GROWTH)
+SLICE_SECONDS = 60
+SLICES = 60               # keep one hour
+REQUEST_TIMEOUT = 8.0     # a request with no answer after this counts as a timeout
+
+
+class LogHistogram:
+    __slots__ = ("counts", "n", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.n = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        idx = math.floor(math.log(value) / _LOG_GROWTH) if value > 0 else -10**6
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.n += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for idx, c in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + c
+        self.n += other.n
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        if not self.n:
+            return None
+        rank = q * (self.n - 1)
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen > rank:
+                if idx == -10**6:
+                    return 0.0
+                # bucket midpoint, clamped to what was actually seen
+                return min(self.max, max(self.min, GROWTH ** (idx + 0.5)))
+        return self.max
+
+    def summary(self, digits=4):
+        if not self.n:
+            return {"count": 0}
+        return {
+            "count": self.n,
+            "mean": round(self.total / self.n, digits),
+            "min": round(self.min, digits),
+            "p50": round(self.quantile(0.5), digits),
+            "p90": round(self.quantile(0.9), digits),
+            "p99": round(self.quantile(0.99), digits),
+            "max": round(self.max, digits),
+        }
+
+
+class _Series:
+    __slots__ = ("rtt", "sizes", "ok", "timeouts", "jitter_sum", "jitter_n")
+
+    def __init__(self):
+        self.rtt = LogHistogram()
+        self.sizes = LogHistogram()
+        self.ok = 0
+        self.timeouts = 0
+        self.jitter_sum = 0.0
+        self.jitter_n = 0
+
+    def merge(self, other):
+        self.rtt.merge(other.rtt)
+        self.sizes.merge(other.sizes)
+        self.ok += other.ok
+        self.timeouts += other.timeouts
+        self.jitter_sum += other.jitter_sum
+        self.jitter_n += other.jitter_n
+
+
+class DeviceStats:
+    def __init__(self, slice_seconds=SLICE_SECONDS, slices=SLICES, request_timeout=REQUEST_TIMEOUT):
+        self.slice_seconds = slice_seconds
+        self.slices = slices
+        self.request_timeout = request_timeout
+        self._slices = {}    # slice number -> {(device, kind): _Series}
+        self._pending = {}   # (device, kind) -> request time
+        self._last_rtt = {}  # (device, kind) -> previous RTT, for jitter
+        self._lock = threading.Lock()
+
+    def _series(self, key, now):
+        n = int(now // self.slice_seconds)
+        current = self._slices.get(n)
+        if current is None:
+            current = self._slices[n] = {}
+            for old in [s for s in self._slices if s <= n - self.slices]:
+                del self._slices[old]
+        series = current.get(key)
+        if series is None:
+            series = current[key] = _Series()
+        return series
+
+    # ---------- recording ----------
+
+    def sent(self, device, kind, now=None, restart=False):
+        # restart=True: a new request in place of the pending one (a direct
+        # retry after a broadcast), so the RTT is measured from `now`
+        now = time.time() if now is None else now
+        key = (device, kind)
+        with self._lock:
+            prev = self._pending.get(key)
+            if prev is not None and now - prev >= self.request_timeout:
+                self._series(key, prev).timeouts += 1
+            if prev is None or restart or now - prev >= self.request_timeout:
+                self._pending[key] = now
+            # a re-send while still waiting keeps the original request time
+
+    def received(self, device, kind, now=None, size=None):
+        now = time.time() if now is None else now
+        key = (device, kind)
+        with self._lock:
+            series = self._series(key, now)
+            if size is not None:
+                series.sizes.add(size)
+            sent = self._pending.pop(key, None)
+            if sent is None:
+                return None
+            rtt = now - sent
+            if rtt >= self.request_timeout:
+                series.timeouts += 1
+                return rtt
+            series.ok += 1
+            series.rtt.add(rtt)
+            last = self._last_rtt.get(key)
+            if last is not None:
+                series.jitter_sum += abs(rtt - last)
+                series.jitter_n += 1
+            self._last_rtt[key] = rtt
+            return rtt
+
+    def _expire_pending(self, now):
+        for key, sent in list(self._pending.items()):
+            if now - sent >= self.request_timeout:
+                self._series(key, sent).timeouts += 1
+                del self._pending[key]
+
+    # ---------- queries ----------
+
+    def merged(self, window=None, now=None):
+        """-> {(device, kind): _Series} over the last `window` seconds."""
+        now = time.time() if now is None else now
+        window = window or self.slice_seconds * self.slices
+        first = int((now - window) // self.slice_seconds)
+        out = {}
+        with self._lock:
+            self._expire_pending(now)
+            for n, series_map in self._slices.items():
+                if n <= first:
+                    continue
+                for key, series in series_map.items():
+                    acc = out.get(key)
+                    if acc is None:
+                        acc = out[key] = _Series()
+                    acc.merge(series)
+        return out
+
+    def summary(self, device=None, window=None, now=None):
+        out = {}
+        for (dev, kind), s in self.merged(window, now).items():
+            if device is not None and dev != device:
+                continue
+            answered = s.ok + s.timeouts
+            entry = {
+                "rtt": s.rtt.summary(),
+                "ok": s.ok,
+                "timeouts": s.timeouts,
+                "success_ratio": round(s.ok / answered, 4) if answered else None,
+                "jitter": round(s.jitter_sum / s.jitter_n, 4) if s.jitter_n else None,
+            }
+            if s.sizes.n:
+                entry["size"] = s.sizes.summary(0)
+            out.setdefault(dev, {})[kind] = entry
+        return out
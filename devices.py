@@ -0,0 +1,70 @@
+"""Device state for the dashboard: one compact record per device.
+
+Every device is a Device (__slots__, no per-instance dict) holding its
+latest frame / reading, heartbeat and request timestamps. The Registry
+indexes devices by id and by every topic they use, so an incoming message
+finds its device and the topic's role ("hb_resp", "pic_resp", ...) with a
+single dict lookup, and a device read is one lookup instead of one per
+parallel dict.
+"""
+
+
+class Device:
+    __slots__ = ("id", "kind", "topics",
+                 "frame", "frame_time", "frame_change_time", "pic_request_time",
+                 "heartbeat", "hb_request_time", "hb_timeout", "broadcast",
+                 "value", "raw_value", "value_time")
+
+    def __init__(self, dev_id, kind, topics):
+        self.id = dev_id
+        self.kind = kind        # "camera", "water", "actuator"
+        self.topics = topics    # role -> topic, e.g. {"hb_req": "ESP32_CAM_1/heartbeat/request"}
+        self.frame = None
+        self.frame_time = None
+        self.frame_change_time = None   # last time the scene actually changed
+        self.pic_request_time = None
+        self.heartbeat = None
+        self.hb_request_time = None
+        self.hb_timeout = None          # timeout in force when the last heartbeat was requested
+        self.broadcast = None           # answers fleet heartbeats? None until a fleet probe tells
+        self.value = None               # filtered reading
+        self.raw_value = None           # last reading as received
+        self.value_time = None
+
+    def __repr__(self):
+        return f"Device({self.id!r}, {self.kind!r})"
+
+
+class Registry:
+    def __init__(self):
+        self.by_id = {}
+        self.by_topic = {}  # topic -> (device, role)
+
+    def add(self, device):
+        if device.id in self.by_id:
+            raise ValueError(f"duplicate device id: {device.id}")
+        self.by_id[device.id] = device
+        for role, topic in device.topics.items():
+            self.by_topic[topic] = (device, role)
+        return device
+
+    def route(self, topic):
+        return self.by_topic.get(topic, (None, None))
+
+    def get(self, dev_id):
+        return self.by_id.get(dev_id)
+
+    def of_kind(self, kind):
+        return [d for d in self.by_id.values() if d.kind == kind]
+
+    def __getitem__(self, dev_id):
+        return self.by_id[dev_id]
+
+    def __contains__(self, dev_id):
+        return dev_id in self.by_id
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
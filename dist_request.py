@@ -1,22 +1,25 @@
-import base64
-import io
 import time
 import paho.mqtt.client as mqtt
-from PIL import Image
 import struct
+from signal_filter import DistanceFilter
 
 BROKER = "192.168.1.100"
 PORT = 1883
 REQ_TOPIC = "esp32/ultrasonic/request"
 RESP_TOPIC = "esp32/ultrasonic/response"
 
+distance_filter = DistanceFilter()
+
 
 
 def on_message(client, userdata, msg):
 
     if msg.topic == RESP_TOPIC:
         dist = struct.unpack('f', msg.payload)[0]
-        print(f"Received distance value: {dist:.2f} cm.")
+        filtered, accepted = distance_filter.update(dist)
+        note = "" if accepted else " (rejected)"
+        shown = f"{filtered:.2f}" if filtered is not None else "--"
+        print(f"Received distance value: {dist:.2f} cm{note}, filtered {shown} cm.")
 
 client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 client.on_message = on_message
@@ -0,0 +1,334 @@
+"""One command-line tool for poking at the ESP32s.
+
+    python esp32ctl.py heartbeat --device ESP32_CAM_1 --count 3
+    python esp32ctl.py snapshot --device ESP32_CAM_1 -o cam1.jpg --verify
+    python esp32ctl.py stream --device esp32
+    python esp32ctl.py distance --device ESP32_WLEVEL_1 --kind distance --count 20
+    python esp32ctl.py telemetry --hours 2            # needs EDENIC_API_KEY
+    python esp32ctl.py bench                          # startup time per subcommand
+
+Topics are <device>/<kind>/request and <device>/<kind>/response. The
+broker defaults to 192.168.1.100 for the "esp32" board and to
+192.168.1.163 for the ESP32_* fleet; --broker or MQTT_BROKER overrides.
+
+Only the standard library is imported at startup. Every subcommand
+imports what it needs when it runs, so `heartbeat` never pays for OpenCV
+and `--help` costs the interpreter plus argparse. `bench` measures that.
+"""
+import argparse
+import os
+import sys
+import time
+
+# the ESP32_* fleet talks to the web app's broker; the standalone "esp32"
+# board (pic_request.py, dist_request.py) to its own
+BROKER = os.environ.get("MQTT_BROKER", "192.168.1.163")
+ESP32_BROKER = os.environ.get("MQTT_BROKER", "192.168.1.100")
+PORT = 1883
+
+TELEMETRY_URL = "https://api.edenic.io/api/v1/telemetry/{device}"
+TELEMETRY_DEVICE = os.environ.get("EDENIC_DEVICE_ID", "989d8280-0691-11f1-8e2c-5b598f4f6273")
+TELEMETRY_KEYS = "temperature,ph,electrical_conductivity"
+
+
+def topics(args):
+    base = f"{args.device}/{args.kind}"
+    return f"{base}/request", f"{base}/response"
+
+
+def connect(args, resp_topic, on_payload):
+    # paho is the one dependency every MQTT subcommand shares
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_message = lambda c, userdata, msg: on_payload(msg.payload, time.time())
+    client.connect(args.broker, args.port)
+    client.subscribe(resp_topic)
+    client.loop_start()
+    return client
+
+
+def close(client):
+    client.loop_stop()
+    client.disconnect()
+
+
+def wait_for(box, timeout):
+    start = time.time()
+    while not box and time.time() - start < timeout:
+        time.sleep(0.01)
+    return box[0] if box else None
+
+
+# ================= COMMANDS =================
+
+def cmd_heartbeat(args):
+    import random
+
+    req, resp = topics(args)
+    replies = []
+    client = connect(args, resp, lambda payload, ts: replies.append((payload, ts)))
+    try:
+        for i in range(args.count):
+            replies.clear()
+            payload = f"alive:{int(time.time())}:{random.randint(1000, 9999)}"
+            sent = time.time()
+            client.publish(req, payload)
+            reply = wait_for(replies, args.timeout)
+            if reply is None:
+                print(f"{args.device}: no reply within {args.timeout:.1f}s")
+            else:
+                print(f"{args.device}: {reply[0].decode(errors='replace')} in {(reply[1] - sent) * 1000:.0f} ms")
+            if i + 1 < args.count:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close(client)
+
+
+def cmd_snapshot(args):
+    from chunked import Reassembler
+
+    req, resp = topics(args)
+    reassembler = Reassembler()
+    frames = []
+
+    def on_payload(payload, ts):
+        frame = reassembler.feed(resp, payload)
+        if frame is not None:
+            frames.append((frame, ts))
+
+    client = connect(args, resp, on_payload)
+    try:
+        sent = time.time()
+        client.publish(req, "get")
+        got = wait_for(frames, args.timeout)
+    finally:
+        close(client)
+    if got is None:
+        print(f"no image within {args.timeout:.0f}s")
+        return 1
+    frame, ts = got
+    if args.verify:
+        import io
+        from PIL import Image
+        try:
+            Image.open(io.BytesIO(frame)).verify()
+        except Exception as e:
+            print(f"decode error: {e}")
+            return 1
+    # the camera already sends JPEG; the bytes are written as they came
+    with open(args.out, "wb") as f:
+        f.write(frame)
+    print(f"{len(frame)} bytes in {(ts - sent) * 1000:.0f} ms -> {args.out}")
+
+
+def cmd_stream(args):
+    import threading
+    import cv2
+    import numpy as np
+    from chunked import Reassembler
+    from device_stats import DeviceStats
+    from frame_pipeline import FramePipeline
+
+    req, resp = topics(args)
+    stats = DeviceStats()
+    reassembler = Reassembler()
+    latest = []
+    lock = threading.Lock()
+
+    def decode(key, payload, received):
+        img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return False
+        with lock:
+            latest[:] = [img]
+        return True
+
+    pipeline = FramePipeline("esp32ctl", decode, workers=2, maxsize=4).start()
+    count = [0]
+
+    def on_payload(payload, ts):
+        frame = reassembler.feed(resp, payload)
+        if frame is None:
+            return
+        stats.received(args.device, "picture", ts, size=len(frame))
+        pipeline.submit(resp, frame, ts)
+        count[0] += 1
+        if count[0] % 20 == 0:
+            s = stats.summary(args.device, window=300)[args.device]["picture"]
+            if s["rtt"]["count"]:
+                print(f"p50 {s['rtt']['p50'] * 1000:.0f} ms, p99 {s['rtt']['p99'] * 1000:.0f} ms, "
+                      f"ok {s['ok']}, timeouts {s['timeouts']}")
+
+    client = connect(args, resp, on_payload)
+    next_request = 0
+    try:
+        # imshow / waitKey have to stay on the main thread
+        while True:
+            now = time.time()
+            if now >= next_request:
+                stats.sent(args.device, "picture", now)
+                client.publish(req, "get")
+                next_request = now + args.interval
+            with lock:
+                img = latest.pop() if latest else None
+            if img is not None:
+                cv2.imshow(args.device, img)
+            if cv2.waitKey(20) & 0xFF == ord("q"):
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cv2.destroyAllWindows()
+        close(client)
+
+
+def cmd_distance(args):
+    import struct
+    from signal_filter import DistanceFilter
+
+    req, resp = topics(args)
+    readings = []
+    client = connect(args, resp, lambda payload, ts: readings.append(payload))
+    f = DistanceFilter()
+    try:
+        for i in range(args.count):
+            readings.clear()
+            client.publish(req, "get")
+            payload = wait_for(readings, args.timeout)
+            if payload is None:
+                print("no reading")
+            elif len(payload) < 4:
+                print(f"bad reading: {len(payload)} bytes")
+            else:
+                raw = struct.unpack("f", payload[:4])[0]
+                value, accepted = f.update(raw)
+                shown = f"{value:.2f}" if value is not None else "--"
+                print(f"{raw:8.2f} cm  filtered {shown} cm{'' if accepted else '  (rejected)'}")
+            if i + 1 < args.count:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close(client)
+
+
+def cmd_telemetry(args):
+    api_key = os.environ.get("EDENIC_API_KEY")
+    if not api_key:
+        print("set EDENIC_API_KEY")
+        return 1
+    import requests
+
+    end_ts = int(time.time() * 1000)
+    params = {
+        "keys": args.keys,
+        "startTs": end_ts - int(args.hours * 3600 * 1000),
+        "endTs": end_ts,
+        "orderBy": "DESC",  # latest first
+        "agg": "NONE",      # raw values, no averaging
+    }
+    response = requests.get(TELEMETRY_URL.format(device=args.device), headers={"Authorization": api_key},
+                            params=params, timeout=10)
+    if response.status_code != 200:
+        print(f"error {response.status_code}: {response.text}")
+        return 1
+    telemetry = response.json()
+    for key in args.keys.split(","):
+        entries = telemetry.get(key) or []
+        if not entries:
+            print(f"\nno data for {key}")
+            continue
+        print(f"\nlast {min(args.last, len(entries))} entries for {key}:")
+        for entry in entries[:args.last]:
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["ts"] / 1000))
+            print(f"{ts} -> {entry['value']}")
+
+
+def cmd_bench(args):
+    import statistics
+    import subprocess
+
+    def run(argv):
+        # -> median wall time in ms, or None if the command fails
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            done = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            times.append((time.perf_counter() - start) * 1000)
+            if done.returncode:
+                return None
+        return statistics.median(times)
+
+    def show(label, ms):
+        if ms is None:
+            print(f"{label:32s}  failed / not installed")
+        else:
+            print(f"{label:32s} {ms:7.1f} ms  (+{ms - base:.1f})")
+
+    base = run([sys.executable, "-c", "pass"])
+    print(f"{'python -c pass':32s} {base:7.1f} ms")
+    for name in COMMANDS:
+        show(f"esp32ctl {name} --help", run([sys.executable, os.path.abspath(__file__), name, "--help"]))
+    # what a subcommand pays once it runs, for comparison
+    for module in ("paho.mqtt.client", "numpy", "cv2", "PIL.Image", "requests"):
+        show(f"import {module}", run([sys.executable, "-c", f"import {module}"]))
+
+
+COMMANDS = {
+    "heartbeat": cmd_heartbeat,
+    "snapshot": cmd_snapshot,
+    "stream": cmd_stream,
+    "distance": cmd_distance,
+    "telemetry": cmd_telemetry,
+    "bench": cmd_bench,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def mqtt_parser(name, help, device, kind, timeout):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--device", default=device)
+        p.add_argument("--kind", default=kind, help="middle topic level")
+        p.add_argument("--broker", help="default: 192.168.1.100 for esp32, 192.168.1.163 otherwise")
+        p.add_argument("--port", type=int, default=PORT)
+        p.add_argument("--timeout", type=float, default=timeout, help="seconds to wait for a reply")
+        return p
+
+    p = mqtt_parser("heartbeat", "ping a device", "ESP32_CAM_1", "heartbeat", 2)
+    p.add_argument("--count", type=int, default=1)
+    p.add_argument("--interval", type=float, default=5)
+
+    p = mqtt_parser("snapshot", "save one picture", "esp32", "picture", 10)
+    p.add_argument("-o", "--out", default="response_image.jpg")
+    p.add_argument("--verify", action="store_true", help="check the JPEG decodes (imports PIL)")
+
+    p = mqtt_parser("stream", "show a live camera window ('q' quits)", "esp32", "picture", 8)
+    p.add_argument("--interval", type=float, default=0.5, help="seconds between picture requests")
+
+    p = mqtt_parser("distance", "read the ultrasonic sensor", "esp32", "ultrasonic", 2)
+    p.add_argument("--count", type=int, default=1)
+    p.add_argument("--interval", type=float, default=0.5)
+
+    p = sub.add_parser("telemetry", help="recent Edenic telemetry (EDENIC_API_KEY)")
+    p.add_argument("--device", default=TELEMETRY_DEVICE)
+    p.add_argument("--keys", default=TELEMETRY_KEYS)
+    p.add_argument("--hours", type=float, default=2)
+    p.add_argument("--last", type=int, default=5, help="entries per key")
+
+    p = sub.add_parser("bench", help="measure startup time of every subcommand")
+    p.add_argument("--runs", type=int, default=5)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "broker", "") is None:
+        args.broker = ESP32_BROKER if args.device == "esp32" else BROKER
+    return COMMANDS[args.command](args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
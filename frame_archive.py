@@ -0,0 +1,114 @@
+"""Append-only on-disk archive of camera frames.
+
+Frames are kept exactly as the camera sent them (JPEG, no re-encode) in one
+segment file per camera per hour:
+
+    <root>/<cam_id>/<YYYYmmdd-HH>.frames
+
+Each record is RECORD ("<2sdI": marker, receive time, length) followed by
+the JPEG bytes. Writers keep the segment open with a large buffer and flush
+on an interval, so a steady stream of frames turns into a few big writes.
+A crash can only lose the unflushed tail; readers stop at a torn record.
+"""
+import os
+import struct
+import threading
+import time
+
+RECORD = struct.Struct("<2sdI")
+MARKER = b"FR"
+SUFFIX = ".frames"
+BUFFER_SIZE = 1 << 20
+
+
+def segment_name(ts):
+    return time.strftime("%Y%m%d-%H", time.localtime(ts)) + SUFFIX
+
+
+def segment_start(name):
+    return time.mktime(time.strptime(name[:-len(SUFFIX)], "%Y%m%d-%H"))
+
+
+class ArchiveWriter:
+    def __init__(self, root, flush_interval=2.0, buffer_size=BUFFER_SIZE):
+        self.root = root
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._files = {}  # cam_id -> (segment name, file)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def append(self, cam_id, ts, payload):
+        name = segment_name(ts)
+        with self._lock:
+            current = self._files.get(cam_id)
+            if current is None or current[0] != name:
+                if current is not None:
+                    current[1].close()
+                folder = os.path.join(self.root, cam_id)
+                os.makedirs(folder, exist_ok=True)
+                f = open(os.path.join(folder, name), "ab", buffering=self.buffer_size)
+                current = self._files[cam_id] = (name, f)
+            f = current[1]
+            f.write(RECORD.pack(MARKER, ts, len(payload)))
+            f.write(payload)
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                for _, other in self._files.values():
+                    other.flush()
+                self._last_flush = now
+
+    def flush(self):
+        with self._lock:
+            for _, f in self._files.values():
+                f.flush()
+
+    def close(self):
+        with self._lock:
+            for _, f in self._files.values():
+                f.close()
+            self._files.clear()
+
+
+def cameras(root):
+    try:
+        return sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    except FileNotFoundError:
+        return []
+
+
+def segments(root, cam_id, start=None, end=None):
+    folder = os.path.join(root, cam_id)
+    try:
+        names = sorted(n for n in os.listdir(folder) if n.endswith(SUFFIX))
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in names:
+        seg_start = segment_start(name)
+        if end is not None and seg_start > end:
+            continue
+        if start is not None and seg_start + 3600 <= start:
+            continue
+        out.append(os.path.join(folder, name))
+    return out
+
+
+def iter_frames(root, cam_id, start=None, end=None):
+    """Yields (ts, jpeg_bytes) in time order, one frame in memory at a time."""
+    for path in segments(root, cam_id, start, end):
+        with open(path, "rb") as f:
+            while True:
+                head = f.read(RECORD.size)
+                if len(head) < RECORD.size:
+                    break
+                marker, ts, length = RECORD.unpack(head)
+                if marker != MARKER:
+                    break
+                if start is not None and ts < start or end is not None and ts > end:
+                    f.seek(length, os.SEEK_CUR)
+                    continue
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield ts, payload
@@ -0,0 +1,98 @@
+"""Frame processing off the MQTT network thread.
+
+on_message only calls submit(), which appends the raw payload to a bounded
+queue and returns. Worker threads pop frames and run `process(key, payload,
+received)`. cv2.imdecode and Pillow release the GIL while decoding, so
+threads are enough to use several cores.
+
+The queue holds at most one frame per key (camera): a newer frame replaces
+the one still waiting, since a newer frame of the same scene is always more
+useful. When `maxsize` keys are waiting, a new key drops the oldest frame.
+"""
+import collections
+import threading
+import time
+
+import applog
+import metrics
+
+log = applog.get_logger("frame_pipeline")
+
+_pipelines = []
+
+FRAMES = metrics.counter("frame_pipeline_frames_total", "Frames by outcome", ("pipeline", "outcome"))
+PROCESS_TIME = metrics.histogram("frame_pipeline_process_seconds", "Validate/decode time per frame", ("pipeline",))
+QUEUE_WAIT = metrics.histogram("frame_pipeline_queue_seconds", "Time frames spent queued", ("pipeline",))
+QUEUE_DEPTH = metrics.gauge("frame_pipeline_queue_depth", "Frames waiting to be processed",
+                            lambda: {(p.name,): len(p.queue) for p in _pipelines}, ("pipeline",))
+
+
+class FramePipeline:
+    def __init__(self, name, process, workers=2, maxsize=16):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queue = collections.OrderedDict()   # key -> latest waiting frame
+        self.unfinished = 0                      # queued or being processed
+        self.cond = threading.Condition()
+        self._threads = []
+        _pipelines.append(self)
+
+    def start(self):
+        if self._threads:
+            return self
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, daemon=True, name=f"{self.name}-{i}")
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def submit(self, key, payload, received=None):
+        # Never blocks. Returns False if a waiting frame had to go.
+        if received is None:
+            received = time.time()
+        with self.cond:
+            if key in self.queue:
+                outcome = "replaced"
+            elif len(self.queue) >= self.maxsize:
+                self.queue.popitem(last=False)
+                outcome = "dropped"
+            else:
+                outcome = None
+                self.unfinished += 1
+            self.queue[key] = (payload, received, time.perf_counter())
+            self.cond.notify()
+        if outcome is not None:
+            FRAMES.inc(self.name, outcome)
+        return outcome is None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                key, (payload, received, queued) = self.queue.popitem(last=False)
+            start = time.perf_counter()
+            QUEUE_WAIT.observe(start - queued, self.name)
+            try:
+                ok = self.process(key, payload, received)
+            except Exception:
+                log.exception("frame processing failed")
+                ok = False
+            PROCESS_TIME.observe(time.perf_counter() - start, self.name)
+            FRAMES.inc(self.name, "rejected" if ok is False else "processed")
+            with self.cond:
+                self.unfinished -= 1
+                if not self.unfinished:
+                    self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until no frame is queued or being processed; False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.unfinished, timeout)
+
+
+def looks_like_jpeg(payload):
+    # SOI at the start and EOI near the end (some encoders pad a few bytes)
+    return len(payload) > 4 and payload[:2] == b"\xff\xd8" and b"\xff\xd9" in payload[-16:]
@@ -0,0 +1,86 @@
+"""Bounded per-class queues between the MQTT network thread and the handlers.
+
+on_message only classifies a message and submits it to a Lane. Every lane
+has its own thread, so a slow class (a lock held by an HTTP handler, a
+rule switching the pump) never holds up another one.
+
+A lane handles every message, in order. When its queue is full, submit()
+waits for room: nothing is dropped, the producer slows down instead
+("blocked"). That suits heartbeat and actuator acks and request/response
+readings, where a dropped message would count as a device timeout. Frames,
+where only the newest matters, go through frame_pipeline's latest-wins
+queue instead.
+
+Outcomes, queue time and depth are exported per lane. join() waits until
+everything submitted has been handled, like queue.Queue.join.
+"""
+import collections
+import threading
+import time
+
+import applog
+import metrics
+
+log = applog.get_logger("ingest_queue")
+
+_lanes = []
+
+MESSAGES = metrics.counter("ingest_messages_total", "Ingested messages by lane and outcome", ("lane", "outcome"))
+QUEUE_WAIT = metrics.histogram("ingest_queue_seconds", "Time messages spent queued", ("lane",))
+QUEUE_DEPTH = metrics.gauge("ingest_queue_depth", "Messages waiting to be handled",
+                            lambda: {(lane.name,): len(lane) for lane in _lanes}, ("lane",))
+
+
+class Lane:
+    def __init__(self, name, handle, maxsize=256):
+        self.name = name
+        self.handle = handle          # handle(*args)
+        self.maxsize = maxsize
+        self.queue = collections.deque()
+        self.unfinished = 0           # submitted, not yet handled
+        self.cond = threading.Condition()
+        self._thread = None
+        _lanes.append(self)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name=f"ingest-{self.name}")
+            self._thread.start()
+        return self
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, *args):
+        with self.cond:
+            if len(self.queue) >= self.maxsize:
+                MESSAGES.inc(self.name, "blocked")
+                while len(self.queue) >= self.maxsize:
+                    self.cond.wait()
+            self.queue.append((args, time.perf_counter()))
+            self.unfinished += 1
+            self.cond.notify_all()
+        MESSAGES.inc(self.name, "queued")
+
+    def join(self, timeout=None):
+        """Wait until every submitted message was handled; False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.unfinished, timeout)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                args, queued = self.queue.popleft()
+                self.cond.notify_all()   # room for a blocked producer
+            QUEUE_WAIT.observe(time.perf_counter() - queued, self.name)
+            try:
+                self.handle(*args)
+            except Exception:
+                log.exception("ingest handler failed")
+            MESSAGES.inc(self.name, "handled")
+            with self.cond:
+                self.unfinished -= 1
+                if not self.unfinished:
+                    self.cond.notify_all()
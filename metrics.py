@@ -0,0 +1,237 @@
+"""Prometheus-style counters and histograms for the MQTT / HTTP hot paths.
+
+Writes are spread over a fixed pool of SHARDS shards, each a plain dict with
+its own lock. A thread is given a shard the first time it writes and keeps
+it, so writers on different threads rarely share a lock; the pool never
+grows, however many short-lived threads (one per HTTP request) come and go.
+A scrape walks all shards and sums them.
+"""
+import itertools
+import threading
+import time
+from bisect import bisect_left
+
+# seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 131072, 262144, 524288,
+                1048576, 4194304)
+
+SHARDS = 16
+
+_registry = []
+_registry_lock = threading.Lock()
+_thread_slot = threading.local()   # index of the shard this thread writes to
+_next_slot = itertools.count()
+
+
+def _slot():
+    try:
+        return _thread_slot.index
+    except AttributeError:
+        index = _thread_slot.index = next(_next_slot) % SHARDS
+        return index
+
+
+class _Sharded:
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._shards = [({}, threading.Lock()) for _ in range(SHARDS)]
+        with _registry_lock:
+            _registry.append(self)
+
+    def _shard(self):
+        # -> (dict, lock) for the calling thread
+        return self._shards[_slot()]
+
+    def _label_str(self, values, extra=None):
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _snapshot_shards(self):
+        out = []
+        for shard, lock in self._shards:
+            with lock:
+                out.append({k: list(v) if isinstance(v, list) else v for k, v in shard.items()})
+        return out
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *labels):
+        shard, lock = self._shard()
+        with lock:
+            shard[labels] = shard.get(labels, 0) + 1
+
+    def add(self, amount, *labels):
+        shard, lock = self._shard()
+        with lock:
+            shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        total = {}
+        for shard in self._snapshot_shards():
+            for key, value in shard.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def render(self):
+        lines = []
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{self._label_str(key)} {value}")
+        return lines
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        shard, lock = self._shard()
+        with lock:
+            slot = shard.get(labels)
+            if slot is None:
+                # [bucket counts..., +Inf count, sum]
+                slot = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            slot[index] += 1
+            slot[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def collect(self):
+        total = {}
+        for shard in self._snapshot_shards():
+            for key, slot in shard.items():
+                acc = total.get(key)
+                if acc is None:
+                    total[key] = list(slot)
+                else:
+                    for i, v in enumerate(slot):
+                        acc[i] += v
+        return total
+
+    def render(self):
+        lines = []
+        for key, slot in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, slot):
+                cumulative += n
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+            cumulative += slot[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {slot[-1]}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value computed at scrape time: fn() returns a number, or a dict of
+    label tuple -> number."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, fn, labels=()):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labels = tuple(labels)
+        with _registry_lock:
+            _registry.append(self)
+
+    _label_str = _Sharded._label_str
+
+    def render(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            return [f"{self.name} {value}"]
+        return [f"{self.name}{self._label_str(key)} {v}" for key, v in sorted(value.items())]
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class TimedLock:
+    """Drop-in for threading.Lock that records how long callers waited."""
+
+    def __init__(self, hist, *labels):
+        self._lock = threading.Lock()
+        self._hist = hist
+        self._labels = labels
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._hist.observe(0.0, *self._labels)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        ok = self._lock.acquire(True, timeout)
+        self._hist.observe(time.perf_counter() - start, *self._labels)
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def counter(name, doc, labels=()):
+    return Counter(name, doc, labels)
+
+
+def histogram(name, doc, labels=(), buckets=TIME_BUCKETS):
+    return Histogram(name, doc, labels, buckets)
+
+
+def gauge(name, doc, fn, labels=()):
+    return Gauge(name, doc, fn, labels)
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    out = []
+    for m in metrics:
+        out.append(f"# HELP {m.name} {m.doc}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.render())
+    return "\n".join(out) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,235 @@
+"""Record MQTT traffic to a file and replay it into the dashboards.
+
+    python mqtt_log.py record capture.mqlog --broker 192.168.1.163 --topic "#"
+    python mqtt_log.py info capture.mqlog
+    python mqtt_log.py replay capture.mqlog --app web_app_3 --speed 1     # real time
+    python mqtt_log.py replay capture.mqlog --app web_app_3 --speed 10    # 10x
+    python mqtt_log.py replay capture.mqlog --app web_app_1 --speed 0     # as fast as possible
+
+The log is append-only: a MAGIC header, then one RECORD per message
+("<2sdHIBB": marker, receive time, topic length, payload length, QoS,
+retain) followed by the topic and payload bytes. Like the frame archive,
+a crash loses at most the unflushed tail and readers stop at a torn record.
+
+Replay imports the app module without connecting it anywhere: its client
+is replaced by one that drops publishes, and every recorded message goes
+through the app's own on_message, in order and with the recorded gaps
+divided by --speed. The summary gives throughput and on_message latency
+(for web_app_3 that is dispatch only; handling happens on its queues).
+"""
+import argparse
+import importlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from device_stats import LogHistogram
+
+MAGIC = b"MQLOG\x00\x01\x00"
+RECORD = struct.Struct("<2sdHIBB")
+MARKER = b"MQ"
+BUFFER_SIZE = 1 << 20
+
+BROKER = "192.168.1.163"
+PORT = 1883
+
+
+# ================= LOG FILE =================
+
+class LogWriter:
+    def __init__(self, path, buffer_size=BUFFER_SIZE):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._f = open(path, "ab", buffering=buffer_size)
+        if new:
+            self._f.write(MAGIC)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.bytes = 0
+
+    def append(self, ts, topic, payload, qos=0, retain=False):
+        raw_topic = topic.encode()
+        with self._lock:
+            self._f.write(RECORD.pack(MARKER, ts, len(raw_topic), len(payload), qos, int(retain)))
+            self._f.write(raw_topic)
+            self._f.write(payload)
+            self.count += 1
+            self.bytes += len(payload)
+
+    def flush(self):
+        with self._lock:
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def read_log(path):
+    """Yields (ts, topic, payload, qos, retain) in file order."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path}: not an MQTT log")
+            pos = len(MAGIC)
+            end = len(m)
+            while pos + RECORD.size <= end:
+                marker, ts, topic_len, payload_len, qos, retain = RECORD.unpack_from(m, pos)
+                start = pos + RECORD.size
+                if marker != MARKER or start + topic_len + payload_len > end:
+                    return  # torn tail
+                topic = m[start:start + topic_len].decode()
+                payload = m[start + topic_len:start + topic_len + payload_len]
+                pos = start + topic_len + payload_len
+                yield ts, topic, payload, qos, bool(retain)
+
+
+# ================= RECORD =================
+
+def record(args):
+    writer = LogWriter(args.log)
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe([(t, args.qos) for t in args.topic])
+
+    def on_message(client, userdata, msg):
+        writer.append(time.time(), msg.topic, msg.payload, msg.qos, msg.retain)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.broker, args.port)
+    client.loop_start()
+    print(f"recording {', '.join(args.topic)} from {args.broker}:{args.port} -> {args.log} (Ctrl-C stops)")
+    start = time.time()
+    try:
+        while args.duration is None or time.time() - start < args.duration:
+            time.sleep(1)
+            writer.flush()
+            print(f"\r{writer.count} messages, {writer.bytes / 1e6:.1f} MB", end="", flush=True)
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    client.disconnect()
+    writer.close()
+    print(f"\n{writer.count} messages recorded")
+
+
+# ================= REPLAY =================
+
+class NullClient:
+    """Stands in for the app's paho client: replays never reach a broker."""
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return None
+
+
+def load_app(name):
+    app = importlib.import_module(name)
+    app.client = NullClient()
+    frames = getattr(app, "frames", None)  # web_app_3 decodes frames on a pipeline
+    if frames is not None:
+        frames.start()
+    for lane in getattr(app, "lanes", ()):  # ... and queues everything else by class
+        lane.start()
+    return app
+
+
+def message(topic, payload, qos, retain):
+    msg = mqtt.MQTTMessage(topic=topic.encode())
+    msg.payload = bytes(payload)
+    msg.qos = qos
+    msg.retain = retain
+    return msg
+
+
+def replay(args):
+    app = load_app(args.app)
+    latency = LogHistogram()
+    count = 0
+    size = 0
+    first_ts = None
+    start = time.perf_counter()
+    for ts, topic, payload, qos, retain in read_log(args.log):
+        if args.speed > 0:
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) / args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        msg = message(topic, payload, qos, retain)
+        t0 = time.perf_counter()
+        app.on_message(app.client, None, msg)
+        latency.add(time.perf_counter() - t0)
+        count += 1
+        size += len(msg.payload)
+    fed = time.perf_counter() - start
+
+    # messages handed to a lane or pipeline may still be queued or in a handler
+    deadline = time.time() + 30
+    for q in [*getattr(app, "lanes", ()), getattr(app, "frames", None)]:
+        if q is not None:
+            q.join(max(0.0, deadline - time.time()))
+    elapsed = time.perf_counter() - start
+
+    print(f"{count} messages, {size / 1e6:.1f} MB replayed into {args.app} in {elapsed:.2f}s "
+          f"(fed in {fed:.2f}s)")
+    if count:
+        print(f"throughput: {count / elapsed:.0f} msg/s, {size / 1e6 / elapsed:.1f} MB/s")
+        s = latency.summary(6)
+        print(f"on_message: p50 {s['p50'] * 1e3:.3f} ms  p99 {s['p99'] * 1e3:.3f} ms  max {s['max'] * 1e3:.3f} ms")
+
+
+def info(args):
+    topics = {}
+    first = last = None
+    for ts, topic, payload, _, _ in read_log(args.log):
+        n, b = topics.get(topic, (0, 0))
+        topics[topic] = (n + 1, b + len(payload))
+        first = ts if first is None else first
+        last = ts
+    if first is None:
+        print("empty log")
+        return
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))} .. "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last))} ({last - first:.1f}s)")
+    for topic, (n, b) in sorted(topics.items()):
+        print(f"{n:8d} {b / 1e3:10.1f} kB  {topic}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("record", help="capture broker traffic into a log")
+    p.add_argument("log")
+    p.add_argument("--broker", default=BROKER)
+    p.add_argument("--port", type=int, default=PORT)
+    p.add_argument("--topic", action="append", help="topic filter, repeatable (default: #)")
+    p.add_argument("--qos", type=int, default=1)
+    p.add_argument("--duration", type=float, help="stop after this many seconds")
+    p.set_defaults(func=record)
+
+    p = sub.add_parser("replay", help="feed a log into an app's on_message")
+    p.add_argument("log")
+    p.add_argument("--app", default="web_app_3", choices=["web_app_1", "web_app_2", "web_app_3"])
+    p.add_argument("--speed", type=float, default=1.0, help="1 = real time, N = N times faster, 0 = max")
+    p.set_defaults(func=replay)
+
+    p = sub.add_parser("info", help="summarize a log")
+    p.add_argument("log")
+    p.set_defaults(func=info)
+
+    args = parser.parse_args()
+    if args.command == "record" and not args.topic:
+        args.topic = ["#"]
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import io
 import time
 import paho.mqtt.client as mqtt
 from PIL import Image
+from chunked import Reassembler
 
 BROKER = "192.168.1.100"
 PORT = 1883
@@ -10,11 +11,16 @@ REQ_TOPIC = "esp32/picture/request"
 RESP_TOPIC = "esp32/picture/response"
 
 image_data = None
+reassembler = Reassembler()
 
 def on_message(client, userdata, msg):
     global image_data
     if msg.topic == RESP_TOPIC:
-        image_data = msg.payload
+        # single-message JPEG or one chunk of a larger frame
+        frame = reassembler.feed(msg.topic, msg.payload)
+        if frame is None:
+            return
+        image_data = frame
         print(f"✅ Received image ({len(image_data)} bytes)")
         # mg.save("response_image.png")
         # print("Image saved as 'response_image.png'")
@@ -36,12 +42,13 @@ while image_data is None and (time.time() - start) < timeout:
     time.sleep(0.1)
 
 if image_data:
+    # The camera already sends JPEG: check it decodes, then write the
+    # original bytes instead of re-encoding to PNG.
     try:
-        img = Image.open(io.BytesIO(image_data))
-        # img.show()
-        # print("🖼️ Displayed!")
-        img.save("response_image.png")
-        print("Image saved as 'response_image.png'")
+        Image.open(io.BytesIO(image_data)).verify()
+        with open("response_image.jpg", "wb") as f:
+            f.write(image_data)
+        print("Image saved as 'response_image.jpg'")
     except Exception as e:
         print(f"❌ Decode error: {e}")
 else:
@@ -0,0 +1,194 @@
+"""Sampling profiler and span tracing, on for a bounded window only.
+
+    session = profiler.start(seconds=10)
+    ...
+    with profiler.span("mqtt", topic):
+        handle_message(...)
+    ...
+    session.wait()
+    text = session.collapsed()     # flamegraph.pl / speedscope input
+
+While a session runs, a timer thread reads every thread's current stack
+(sys._current_frames) each `interval` seconds and counts it as one
+collapsed line:
+
+    <thread>;<open spans>;module:function;...;module:function:line 17
+
+Open spans are the span() blocks the thread is inside, so one flame graph
+separates time in MQTT dispatch from time in each HTTP endpoint. The leaf
+keeps its line number: a thread waiting for a lock shows up on the line
+that takes it. Samples whose leaf is in threading / queue / selectors /
+socket, or an idle ThreadPoolExecutor worker (concurrent.futures.thread,
+blocked in the C-level queue get), are idle waits and left out unless
+idle=True.
+
+span() also records its duration per label (quantiles in summary()).
+Outside a session it costs one global read, so it stays in the hot path.
+"""
+import os
+import sys
+import threading
+import time
+
+from device_stats import LogHistogram
+
+INTERVAL = 0.01       # s between samples
+MAX_SECONDS = 25      # an HTTP handler waits out the session: stay under gunicorn's 30 s --timeout
+MAX_DEPTH = 64
+IDLE_MODULES = {"threading", "thread", "queue", "selectors", "socket", "socketserver", "ssl", "connection"}
+
+_session = None        # the session running now, if any
+_last = None           # the most recent session, running or finished
+_start_lock = threading.Lock()
+
+
+class Session:
+    def __init__(self, seconds, interval=INTERVAL, idle=False):
+        self.seconds = min(seconds, MAX_SECONDS)
+        self.interval = interval
+        self.idle = idle
+        self.started = time.time()
+        self.samples = 0
+        self.stacks = {}      # collapsed stack -> samples
+        self.open_spans = {}  # thread ident -> [span label, ...]
+        self.span_time = {}   # span label -> LogHistogram of durations
+        self._names = {}      # thread ident -> thread name
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def running(self):
+        return not self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    # ---------- sampling ----------
+
+    def _run(self):
+        global _session
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                self._sample(me)
+                time.sleep(self.interval)
+        finally:
+            _session = None
+            self._done.set()
+
+    def _sample(self, me):
+        frames = sys._current_frames()
+        if frames.keys() - self._names.keys():
+            self._names = {t.ident: t.name for t in threading.enumerate()}
+        # walk the stacks before taking the lock that span() needs
+        stacks = [(ident, self._stack(frame)) for ident, frame in frames.items() if ident != me]
+        del frames
+        with self._lock:
+            for ident, stack in stacks:
+                if stack is None:
+                    continue
+                spans = self.open_spans.get(ident)
+                if spans:
+                    stack = ";".join(spans) + ";" + stack
+                key = self._names.get(ident, str(ident)) + ";" + stack
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def _stack(self, frame):
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        if not self.idle and module in IDLE_MODULES:
+            return None
+        parts = [f"{module}:{code.co_name}:{frame.f_lineno}"]
+        frame = frame.f_back
+        while frame is not None and len(parts) < MAX_DEPTH:
+            code = frame.f_code
+            parts.append(f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}")
+            frame = frame.f_back
+        parts.reverse()
+        return ";".join(parts)
+
+    # ---------- spans ----------
+
+    def _enter(self, ident, label):
+        with self._lock:
+            self.open_spans.setdefault(ident, []).append(label)
+
+    def _exit(self, ident, label, elapsed):
+        with self._lock:
+            spans = self.open_spans.get(ident)
+            if spans:
+                spans.pop()
+            hist = self.span_time.get(label)
+            if hist is None:
+                hist = self.span_time[label] = LogHistogram()
+            hist.add(elapsed)
+
+    # ---------- results ----------
+
+    def collapsed(self, prefix=None):
+        """Brendan Gregg's collapsed format, one "stack count" line each."""
+        with self._lock:
+            items = sorted(self.stacks.items(), key=lambda kv: -kv[1])
+        head = prefix + ";" if prefix else ""
+        return "".join(f"{head}{stack} {count}\n" for stack, count in items)
+
+    def summary(self, top=20):
+        with self._lock:
+            leaves = {}
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            spans = {name: h.summary(6) for name, h in self.span_time.items()}
+            samples = self.samples
+        return {
+            "running": self.running,
+            "started": self.started,
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "samples": samples,
+            "spans": spans,
+            "top": sorted(leaves.items(), key=lambda kv: -kv[1])[:top],
+        }
+
+
+class span:
+    """Context manager naming a block for the profiler; free when it's off."""
+    __slots__ = ("name", "detail", "label", "session", "start")
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.session = None
+
+    def __enter__(self):
+        session = _session
+        if session is not None:
+            self.session = session
+            self.label = self.name if self.detail is None else f"{self.name} {self.detail}"
+            session._enter(threading.get_ident(), self.label)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.session is not None:
+            self.session._exit(threading.get_ident(), self.label, time.perf_counter() - self.start)
+            self.session = None
+        return False
+
+
+def start(seconds, interval=INTERVAL, idle=False):
+    """Start a session; RuntimeError if one is already running."""
+    global _session, _last
+    with _start_lock:
+        if _session is not None:
+            raise RuntimeError("a profile is already running")
+        session = Session(seconds, max(interval, 0.001), idle)
+        _session = _last = session
+    threading.Thread(target=session._run, daemon=True, name="profiler").start()
+    return session
+
+
+def last():
+    return _last
@@ -0,0 +1,120 @@
+"""Prioritized outbound MQTT publishing.
+
+Everything the dashboard publishes goes through one queue drained by a
+sender thread in strict priority order: actuator commands first, then
+heartbeat / reading requests, then picture requests. A burst of picture
+requests can't delay a pump command or a liveness ping.
+
+Each priority can be routed to its own client, so picture traffic (and the
+large JPEG responses that come back on that connection) can live on a
+separate socket from the control traffic.
+
+paho queues whatever it is handed without limit, and once a message is in
+paho's outbox the priority order no longer applies. The sender therefore
+hands at most MAX_INFLIGHT unsent messages to each client and keeps the
+rest in the heap, where a later control message still goes first. A
+message counts as sent once paho has written it (QoS 0) or has its PUBACK
+(QoS 1). One stuck for INFLIGHT_TIMEOUT stops counting, so a dead
+connection can't stall the sender for good.
+
+A publish that raises (bad topic, no client yet) is logged and counted;
+the sender carries on with the next message.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+import applog
+import metrics
+
+log = applog.get_logger("publisher")
+
+CONTROL, HEARTBEAT, BULK = 0, 1, 2
+NAMES = {CONTROL: "control", HEARTBEAT: "heartbeat", BULK: "bulk"}
+MAX_INFLIGHT = 8        # unsent messages handed to one client
+INFLIGHT_TIMEOUT = 5.0  # s before an unsent message stops counting
+POLL = 0.01             # s between checks while a client is full
+
+_publishers = []
+
+QUEUE_WAIT = metrics.histogram("publish_queue_seconds", "Time from publish() to hand-off to paho", ("priority",))
+ERRORS = metrics.counter("publish_errors_total", "Publishes paho refused", ("priority",))
+QUEUE_DEPTH = metrics.gauge("publish_queue_depth", "Messages waiting to be published",
+                            lambda: _depths(), ("priority",))
+
+
+def _depths():
+    out = {}
+    for p in _publishers:
+        for prio, n in p.depths().items():
+            out[(NAMES[prio],)] = out.get((NAMES[prio],), 0) + n
+    return out
+
+
+class PriorityPublisher:
+    def __init__(self, clients):
+        # clients: {priority: callable returning the paho client to use}
+        self.clients = clients
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._inflight = {}   # client -> [(MQTTMessageInfo, hand-off time)] not yet sent
+        _publishers.append(self)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="publisher")
+            self._thread.start()
+
+    def publish(self, topic, payload, qos=0, priority=BULK, retain=False):
+        with self._cond:
+            heapq.heappush(self._heap, (priority, next(self._seq), time.perf_counter(), topic, payload, qos, retain))
+            self._cond.notify()
+
+    def depths(self):
+        with self._cond:
+            out = {}
+            for item in self._heap:
+                out[item[0]] = out.get(item[0], 0) + 1
+            return out
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while not self._heap:
+                        self._cond.wait()
+                    client = self.clients[self._heap[0][0]]()
+                    if self._has_room(client):
+                        break
+                    # paho is behind on this connection; meanwhile a more
+                    # urgent message may arrive and go to the top
+                    self._cond.wait(POLL)
+                priority, _, queued, topic, payload, qos, retain = heapq.heappop(self._heap)
+            QUEUE_WAIT.observe(time.perf_counter() - queued, NAMES[priority])
+            try:
+                info = client.publish(topic, payload, qos=qos, retain=retain)
+            except Exception as e:
+                ERRORS.inc(NAMES[priority])
+                applog.warning(log, "publish failed", topic=topic, error=e)
+                continue
+            self._inflight.setdefault(client, []).append((info, time.monotonic()))
+
+    def _has_room(self, client):
+        pending = self._inflight.get(client)
+        if not pending:
+            return True
+        now = time.monotonic()
+        pending = self._inflight[client] = [(info, t) for info, t in pending
+                                            if not _settled(info) and now - t <= INFLIGHT_TIMEOUT]
+        return len(pending) < MAX_INFLIGHT
+
+
+def _settled(info):
+    # written / acked, or never queued by paho (is_published raises then)
+    try:
+        return info.is_published()
+    except Exception:
+        return True
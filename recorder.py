@@ -0,0 +1,161 @@
+"""Headless recorder for every camera at once.
+
+    python recorder.py archive/                          # ESP32_CAM_1..4
+    python recorder.py archive/ --camera ESP32_CAM_1 --camera esp32 --interval 1
+    python recorder.py archive/ --duration 600 --report 10
+
+Frames go into a frame_archive (one segment per camera per hour, readable
+by timelapse.py) exactly as the camera sent them: no decode, no re-encode.
+The MQTT thread only reassembles chunks and appends to the writer's
+buffer; the main thread flushes the buffers once per --flush seconds, so
+disk writes are a few large ones made off the network thread.
+
+Each camera is paced on its own: at most one picture request is in
+flight, the next one goes out --interval seconds after the previous one
+was sent (or as soon as the frame arrives, if that's later), and a
+request that gets no frame within the camera's adaptive timeout is
+re-sent. A slow camera therefore never holds back a fast one. Every
+--report seconds one line per camera shows FPS and request latency.
+"""
+import argparse
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from chunked import Reassembler
+from device_stats import REQUEST_TIMEOUT, DeviceStats
+from devices import Device, Registry
+from frame_archive import ArchiveWriter
+from timeouts import AdaptiveTimeouts
+
+BROKER = "192.168.1.163"
+PORT = 1883
+CAMERAS = [f"ESP32_CAM_{i}" for i in range(1, 5)]
+
+
+class Recorder:
+    def __init__(self, client, writer, cam_ids, interval):
+        self.client = client
+        self.writer = writer
+        self.interval = interval
+        self.devices = Registry()
+        for cam_id in cam_ids:
+            self.devices.add(Device(cam_id, "camera", {
+                "pic_req": f"{cam_id}/picture/request",
+                "pic_resp": f"{cam_id}/picture/response",
+            }))
+        self.stats = DeviceStats()
+        self.timeouts = AdaptiveTimeouts(initial=4, minimum=0.5, maximum=REQUEST_TIMEOUT)
+        self.reassembler = Reassembler()
+        self.next_request = {cam_id: 0.0 for cam_id in cam_ids}
+        self.frames = {cam_id: 0 for cam_id in cam_ids}   # since the last report
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def subscriptions(self):
+        return [(dev.topics["pic_resp"], 1) for dev in self.devices]
+
+    def on_message(self, client, userdata, msg):
+        dev, role = self.devices.route(msg.topic)
+        if role != "pic_resp":
+            return
+        frame = self.reassembler.feed(msg.topic, msg.payload)
+        if frame is None:
+            return
+        now = time.time()
+        self.writer.append(dev.id, now, frame)
+        rtt = self.stats.received(dev.id, "picture", now, size=len(frame))
+        self.timeouts.observe(dev.id, rtt)
+        with self._lock:
+            if dev.pic_request_time is not None:
+                self.next_request[dev.id] = max(dev.pic_request_time + self.interval, now)
+            dev.pic_request_time = None
+            dev.frame_time = now
+            self.frames[dev.id] += 1
+            self.bytes += len(frame)
+
+    def pace(self, now):
+        # called from the main loop; sends whatever requests are due
+        due = []
+        with self._lock:
+            for dev in self.devices:
+                sent = dev.pic_request_time
+                if sent is not None:
+                    if now - sent < self.timeouts.timeout(dev.id):
+                        continue
+                    self.timeouts.timed_out(dev.id)
+                elif now < self.next_request[dev.id]:
+                    continue
+                dev.pic_request_time = now
+                due.append(dev)
+        for dev in due:
+            self.stats.sent(dev.id, "picture", now)
+            self.client.publish(dev.topics["pic_req"], "get")
+
+    def report(self, elapsed, window):
+        with self._lock:
+            frames, self.frames = self.frames, dict.fromkeys(self.frames, 0)
+            size, self.bytes = self.bytes, 0
+        summary = self.stats.summary(window=window)
+        print(f"--- {time.strftime('%H:%M:%S')}  {size / 1e6 / elapsed:.2f} MB/s")
+        for dev in self.devices:
+            s = summary.get(dev.id, {}).get("picture")
+            line = f"{dev.id:16s} {frames[dev.id] / elapsed:5.2f} fps"
+            if s and s["rtt"]["count"]:
+                line += (f"  p50 {s['rtt']['p50'] * 1000:5.0f} ms  p99 {s['rtt']['p99'] * 1000:5.0f} ms"
+                         f"  ok {s['ok']}  timeouts {s['timeouts']}")
+            else:
+                line += "  no frames yet" if dev.frame_time is None else ""
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="archive root (same layout as WEB_APP_ARCHIVE)")
+    parser.add_argument("--camera", action="append", help="camera id, repeatable (default: ESP32_CAM_1..4)")
+    parser.add_argument("--broker", default=BROKER)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between requests per camera")
+    parser.add_argument("--flush", type=float, default=2.0, help="seconds between buffer flushes")
+    parser.add_argument("--report", type=float, default=5.0, help="seconds between reports")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args()
+
+    # flushing is driven from the loop below, never from the MQTT thread
+    writer = ArchiveWriter(args.archive, flush_interval=float("inf"))
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    recorder = Recorder(client, writer, args.camera or CAMERAS, args.interval)
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe(recorder.subscriptions())
+
+    client.on_connect = on_connect
+    client.on_message = recorder.on_message
+    client.connect(args.broker, args.port)
+    client.loop_start()
+    print(f"recording {len(recorder.devices)} cameras from {args.broker}:{args.port} -> {args.archive} "
+          f"(Ctrl-C stops)")
+
+    start = last_flush = last_report = time.time()
+    try:
+        while args.duration is None or time.time() - start < args.duration:
+            now = time.time()
+            recorder.pace(now)
+            if now - last_flush >= args.flush:
+                writer.flush()
+                last_flush = now
+            if now - last_report >= args.report:
+                recorder.report(now - last_report, args.report)
+                last_report = now
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    client.disconnect()
+    writer.close()
+    print(f"done after {time.time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
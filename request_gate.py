@@ -0,0 +1,108 @@
+"""Protect the ESP32s from request floods.
+
+Every device request goes through RequestGate.request():
+
+- if a request with the same key (the topic without "/request", e.g.
+  "ESP32_CAM_1/picture") is still in flight, the caller is attached to it
+  and nothing is published;
+- otherwise the device's token bucket must have a token, or the request is
+  refused;
+- the request stays in flight until complete() sees the matching
+  "/response" topic, or until `timeout`.
+
+Callers get the in-flight entry back and may wait() on it.
+"""
+import threading
+import time
+
+import metrics
+
+RATE = 1.0     # requests per second per device
+BURST = 4
+TIMEOUT = 4.0
+
+REQUESTS = metrics.counter("request_gate_total", "Device requests by outcome", ("device", "outcome"))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class InFlight:
+    __slots__ = ("key", "started", "deadline", "done", "waiters")
+
+    def __init__(self, key, now, timeout):
+        self.key = key
+        self.started = now
+        self.deadline = now + timeout
+        self.done = threading.Event()
+        self.waiters = 1
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+def request_key(topic):
+    for suffix in ("/request", "/response"):
+        if topic.endswith(suffix):
+            return topic[:-len(suffix)]
+    return topic
+
+
+class RequestGate:
+    def __init__(self, rate=RATE, burst=BURST, timeout=TIMEOUT):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self._buckets = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def request(self, topic, send):
+        """-> (status, entry): status is "sent", "coalesced" or "rate_limited"
+        (entry is then the seconds until a token is available)."""
+        key = request_key(topic)
+        device = topic.split("/", 1)[0]
+        now = time.monotonic()
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None and now < entry.deadline and not entry.done.is_set():
+                entry.waiters += 1
+                REQUESTS.inc(device, "coalesced")
+                return "coalesced", entry
+            bucket = self._buckets.get(device)
+            if bucket is None:
+                bucket = self._buckets[device] = TokenBucket(self.rate, self.burst)
+            if not bucket.take(now):
+                REQUESTS.inc(device, "rate_limited")
+                return "rate_limited", bucket.retry_after()
+            if len(self._inflight) > 1024:
+                self._inflight = {k: e for k, e in self._inflight.items() if now < e.deadline}
+            entry = self._inflight[key] = InFlight(key, now, self.timeout)
+        REQUESTS.inc(device, "sent")
+        send()
+        return "sent", entry
+
+    def complete(self, topic):
+        key = request_key(topic)
+        with self._lock:
+            entry = self._inflight.pop(key, None)
+        if entry is not None:
+            entry.done.set()
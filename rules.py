@@ -0,0 +1,206 @@
+"""Closed-loop rules from sensor readings to actuators.
+
+Rules run on the thread that handles readings (web_app_3's reading lane):
+when a reading comes in, only the rules registered for its topic are
+evaluated (a dict lookup, no scan), and a rule that fires calls the
+actuator engine straight away, skipping the click-coalescing window.
+
+HysteresisRule switches on when the value crosses `on_at` and off when it
+crosses back over `off_at`. Whether "crossing" means going up or down
+follows from which threshold is larger. The band between the two keeps
+the actuator from chattering. `min_on` / `min_off` hold a state for at
+least that long; since rules only run on events, a held switch happens on
+the first reading after the hold expires.
+
+Because of that, a sensor that stops reporting would leave an actuator
+on forever. RuleEngine.check(), run from a timer, is the fail-safe: an
+actuator a rule switched on is switched off once it has been on for
+`max_on`, or once the rule's last reading is older than `stale_after`.
+After a max_on trip the rule stays off until the value crosses `off_at`
+(the level really moved) or an operator sets the actuator: a stuck sensor
+or a dry source must not cycle the pump on again every `min_off`.
+
+An operator's set() wins over the rules: RuleEngine.manual() keeps the
+actuator's rules quiet for MANUAL_HOLD seconds, and clears a trip.
+
+on_event() and check() run on different threads; the rule fields they
+change are only touched under the engine lock.
+
+Latency is measured per rule from the triggering message to the device's
+ack of the resulting command (rule_actuation_seconds; quantiles in
+RuleEngine.summary()).
+"""
+import threading
+import time
+
+import applog
+import metrics
+from device_stats import LogHistogram
+
+log = applog.get_logger("rules")
+
+MANUAL_HOLD = 600.0   # s the rules leave an actuator alone after an operator set it
+
+EVAL_TIME = metrics.histogram("rule_eval_seconds", "Time to evaluate the rules for one message")
+ACTIONS = metrics.counter("rule_actions_total", "Rule decisions", ("rule", "action"))
+ACTUATION = metrics.histogram("rule_actuation_seconds", "Sensor message to actuator ack", ("rule",),
+                              buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0))
+
+
+class HysteresisRule:
+    __slots__ = ("name", "topic", "actuator", "on_at", "off_at", "min_on", "min_off", "max_on", "stale_after",
+                 "switched_at", "last_value", "last_time", "last_action", "tripped", "manual_until")
+
+    def __init__(self, name, topic, actuator, on_at, off_at, min_on=0.0, min_off=0.0,
+                 max_on=None, stale_after=None):
+        if on_at == off_at:
+            raise ValueError(f"rule {name}: on_at and off_at must differ")
+        self.name = name
+        self.topic = topic
+        self.actuator = actuator
+        self.on_at = on_at
+        self.off_at = off_at
+        self.min_on = min_on
+        self.min_off = min_off
+        self.max_on = max_on
+        self.stale_after = stale_after
+        self.switched_at = 0.0
+        self.last_value = None
+        self.last_time = None
+        self.last_action = None
+        self.tripped = False      # max_on fired; off until the value crosses off_at
+        self.manual_until = 0.0   # an operator set the actuator; hands off until then
+
+    def decide(self, value, current, now):
+        """-> 1 / 0 to switch, "hold" if a minimum time blocks the switch, None otherwise."""
+        self.last_value = value
+        rising = self.on_at > self.off_at
+        if self.tripped:
+            if value <= self.off_at if rising else value >= self.off_at:
+                self.tripped = False
+            return None
+        if now < self.manual_until:
+            return None
+        if current:
+            want_off = value <= self.off_at if rising else value >= self.off_at
+            if not want_off:
+                return None
+            if now - self.switched_at < self.min_on:
+                return "hold"
+            return 0
+        want_on = value >= self.on_at if rising else value <= self.on_at
+        if not want_on:
+            return None
+        if now - self.switched_at < self.min_off:
+            return "hold"
+        return 1
+
+    def overdue(self, now):
+        """-> "max_on" / "stale" if an actuator this rule switched on must go off now."""
+        if self.last_action != "on":
+            return None
+        if self.max_on is not None and now - self.switched_at >= self.max_on:
+            return "max_on"
+        if self.stale_after is not None and now - (self.last_time or self.switched_at) > self.stale_after:
+            return "stale"
+        return None
+
+    def as_dict(self):
+        return {"topic": self.topic, "actuator": self.actuator, "on_at": self.on_at, "off_at": self.off_at,
+                "min_on": self.min_on, "min_off": self.min_off, "max_on": self.max_on,
+                "stale_after": self.stale_after, "last_value": self.last_value,
+                "last_time": self.last_time, "last_action": self.last_action, "tripped": self.tripped,
+                "manual_until": self.manual_until or None}
+
+
+class RuleEngine:
+    def __init__(self, actuators, rules=()):
+        # actuators: actuators.ActuatorEngine
+        self.actuators = actuators
+        self.by_topic = {}   # topic -> [rules]
+        self._pending = {}   # actuator name -> (rule, value, message time)
+        self._latency = {}   # rule name -> LogHistogram
+        self._lock = threading.Lock()
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        self.by_topic.setdefault(rule.topic, []).append(rule)
+        self._latency[rule.name] = LogHistogram()
+
+    def on_event(self, topic, value, received=None):
+        """Evaluate the rules for one reading; `received` = time.time() of the message."""
+        rules = self.by_topic.get(topic)
+        if not rules or value is None:
+            return
+        start = time.perf_counter()
+        now = time.time()
+        received = now if received is None else received
+        for rule in rules:
+            with self._lock:
+                rule.last_time = received
+                current = self.actuators.state(rule.actuator)["state"]
+                action = rule.decide(value, current, now)
+                if action is None:
+                    continue
+                if action == "hold":
+                    ACTIONS.inc(rule.name, "held")
+                    continue
+                rule.switched_at = now
+                rule.last_action = "on" if action else "off"
+                ACTIONS.inc(rule.name, rule.last_action)
+                self._pending[rule.actuator] = (rule, action, received)
+                self.actuators.set(rule.actuator, action, immediate=True)
+            applog.info(log, "rule fired", rule=rule.name, actuator=rule.actuator, value=value,
+                        action=rule.last_action)
+        EVAL_TIME.observe(time.perf_counter() - start)
+
+    def check(self, now=None):
+        # run from a timer, not on events: the events may be what stopped
+        now = time.time() if now is None else now
+        for rules in self.by_topic.values():
+            for rule in rules:
+                with self._lock:
+                    reason = rule.overdue(now)
+                    if reason is None:
+                        continue
+                    rule.switched_at = now
+                    rule.last_action = "off"
+                    rule.tripped = reason == "max_on"
+                    ACTIONS.inc(rule.name, f"off_{reason}")
+                    switched = self.actuators.state(rule.actuator)["state"]
+                    if switched:
+                        self.actuators.set(rule.actuator, 0, immediate=True)
+                if switched:
+                    applog.warning(log, "rule fail-safe", rule=rule.name, actuator=rule.actuator, reason=reason,
+                                   last_value=rule.last_value)
+
+    def manual(self, actuator, now=None):
+        """An operator set `actuator`: its rules stand back for MANUAL_HOLD and forget a trip."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._pending.pop(actuator, None)
+            for rules in self.by_topic.values():
+                for rule in rules:
+                    if rule.actuator == actuator:
+                        rule.manual_until = now + MANUAL_HOLD
+                        rule.tripped = False
+                        rule.last_action = "manual"
+
+    def on_ack(self, actuator, value, now=None):
+        # call with the reported value when an actuator acks
+        now = time.time() if now is None else now
+        with self._lock:
+            pending = self._pending.get(actuator)
+            if pending is None or pending[1] != value:
+                return
+            del self._pending[actuator]
+            rule, _, received = pending
+            self._latency[rule.name].add(now - received)
+        ACTUATION.observe(now - received, rule.name)
+
+    def summary(self):
+        with self._lock:
+            latency = {name: h.summary() for name, h in self._latency.items()}
+            return {rule.name: dict(rule.as_dict(), actuation_latency=latency[rule.name])
+                    for rules in self.by_topic.values() for rule in rules}
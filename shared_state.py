@@ -0,0 +1,320 @@
+"""Share the dashboard state between one MQTT ingest process and any number
+of HTTP worker processes.
+
+The ingest process owns the MQTT connection. It mirrors its state (the
+nested dict returned by export_state()) into a multiprocessing.shared_memory
+block; workers copy changed entries back into their own module dicts, so
+read-only routes work unchanged. Anything that publishes or waits on
+devices is sent to the ingest process over a local socket instead.
+
+Shared memory layout (single writer, lock-free readers):
+
+    header      "<4sIIIQ"      magic, blob slots, blob size, value slots, generation
+    blob dir    "<48sQI4x"     key, seq, length        (one per blob slot)
+    value dir   "<48sQd"       key, seq, value         (one per value slot)
+    blob data   blob slots x blob size
+
+Every slot is a seqlock: the writer makes seq odd, writes, makes it even
+again; a reader retries if seq was odd or moved while it copied. None is
+stored as NaN.
+"""
+import math
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import applog
+
+MAGIC = b"WST1"
+HEADER = struct.Struct("<4sIIIQ")
+BLOB_DIR = struct.Struct("<48sQI4x")
+VALUE_DIR = struct.Struct("<48sQd")
+SEQ = struct.Struct("<Q")
+KEY_SIZE = 48
+GEN_OFFSET = 16
+
+log = applog.get_logger("shared_state")
+
+
+def _flatten(state):
+    for key, value in state.items():
+        if isinstance(value, dict):
+            for sub, v in value.items():
+                yield f"{key}/{sub}", v
+        else:
+            yield key, value
+
+
+def _unflatten(items):
+    state = {}
+    for key, value in items:
+        outer, sep, inner = key.partition("/")
+        if sep:
+            state.setdefault(outer, {})[inner] = value
+        else:
+            state[key] = value
+    return state
+
+
+class FrameStore:
+    def __init__(self, name, blob_slots=16, blob_size=512 * 1024, value_slots=256, create=False):
+        if create:
+            size = HEADER.size + blob_slots * BLOB_DIR.size + value_slots * VALUE_DIR.size + blob_slots * blob_size
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # left over from a crashed ingest process
+                old = shared_memory.SharedMemory(name=name)
+                old.close()
+                old.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            HEADER.pack_into(self.shm.buf, 0, MAGIC, blob_slots, blob_size, value_slots, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Python < 3.13 registers attached blocks too and would unlink
+            # the ingest process's memory when a worker exits.
+            try:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            except Exception:
+                pass
+            magic, blob_slots, blob_size, value_slots, _ = HEADER.unpack_from(self.shm.buf, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{name} is not a frame store")
+        self.owner = create
+        self.buf = self.shm.buf
+        self.blob_slots = blob_slots
+        self.blob_size = blob_size
+        self.value_slots = value_slots
+        self.blob_dir = HEADER.size
+        self.value_dir = self.blob_dir + blob_slots * BLOB_DIR.size
+        self.blob_data = self.value_dir + value_slots * VALUE_DIR.size
+        self._blob_index = {}
+        self._value_index = {}
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # ---------- writer ----------
+
+    def _slot(self, index, directory, dir_struct, slots, key):
+        slot = index.get(key)
+        if slot is not None:
+            return slot
+        raw = key.encode()
+        if len(raw) > KEY_SIZE:
+            raise ValueError(f"key too long: {key}")
+        slot = len(index)
+        if slot >= slots:
+            raise ValueError(f"frame store full, no slot for {key}")
+        off = directory + slot * dir_struct.size
+        self.buf[off:off + KEY_SIZE] = raw.ljust(KEY_SIZE, b"\0")
+        index[key] = slot
+        return slot
+
+    def put_blob(self, key, data):
+        if len(data) > self.blob_size:
+            raise ValueError(f"{key}: {len(data)} bytes does not fit a {self.blob_size} byte slot")
+        slot = self._slot(self._blob_index, self.blob_dir, BLOB_DIR, self.blob_slots, key)
+        off = self.blob_dir + slot * BLOB_DIR.size
+        _, seq, _ = BLOB_DIR.unpack_from(self.buf, off)
+        SEQ.pack_into(self.buf, off + KEY_SIZE, seq + 1)
+        data_off = self.blob_data + slot * self.blob_size
+        self.buf[data_off:data_off + len(data)] = data
+        struct.pack_into("<I", self.buf, off + KEY_SIZE + 8, len(data))
+        SEQ.pack_into(self.buf, off + KEY_SIZE, seq + 2)
+
+    def put_value(self, key, value):
+        slot = self._slot(self._value_index, self.value_dir, VALUE_DIR, self.value_slots, key)
+        off = self.value_dir + slot * VALUE_DIR.size
+        _, seq, _ = VALUE_DIR.unpack_from(self.buf, off)
+        SEQ.pack_into(self.buf, off + KEY_SIZE, seq + 1)
+        struct.pack_into("<d", self.buf, off + KEY_SIZE + 8, math.nan if value is None else float(value))
+        SEQ.pack_into(self.buf, off + KEY_SIZE, seq + 2)
+
+    def bump_generation(self):
+        gen = SEQ.unpack_from(self.buf, GEN_OFFSET)[0]
+        SEQ.pack_into(self.buf, GEN_OFFSET, gen + 1)
+
+    # ---------- readers ----------
+
+    def generation(self):
+        return SEQ.unpack_from(self.buf, GEN_OFFSET)[0]
+
+    def _read_slot(self, off, dir_struct, read, seen):
+        # -> (key, value), or None if the slot is unchanged / being rewritten
+        for _ in range(100):
+            raw_key, seq, field = dir_struct.unpack_from(self.buf, off)
+            key = raw_key.rstrip(b"\0").decode()
+            if seen.get(key) == seq:
+                return None
+            if seq & 1:
+                continue
+            value = read(field)
+            if SEQ.unpack_from(self.buf, off + KEY_SIZE)[0] == seq:
+                seen[key] = seq
+                return key, value
+        return None
+
+    def read_changed(self, seen):
+        # seen: {key: seq} from the previous call, updated in place.
+        # Returns [(key, value)] for entries written since then.
+        changed = []
+        for slot in range(self.blob_slots):
+            off = self.blob_dir + slot * BLOB_DIR.size
+            if SEQ.unpack_from(self.buf, off + KEY_SIZE)[0] == 0:
+                break  # slots are handed out in order, the rest are unused
+            data_off = self.blob_data + slot * self.blob_size
+            entry = self._read_slot(off, BLOB_DIR, lambda n: bytes(self.buf[data_off:data_off + n]) or None, seen)
+            if entry:
+                changed.append(entry)
+        for slot in range(self.value_slots):
+            off = self.value_dir + slot * VALUE_DIR.size
+            if SEQ.unpack_from(self.buf, off + KEY_SIZE)[0] == 0:
+                break
+            entry = self._read_slot(off, VALUE_DIR, lambda v: None if math.isnan(v) else v, seen)
+            if entry:
+                changed.append(entry)
+        return changed
+
+
+class StoreWriter:
+    """Ingest side: mirrors export() into the store whenever `changed` fires."""
+
+    def __init__(self, store, export, changed, interval=0.5):
+        self.store = store
+        self.export = export
+        self.changed = changed  # threading.Event set by on_message
+        self.interval = interval
+        self._written = {}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="store-writer").start()
+
+    def write(self):
+        dirty = False
+        current = dict(_flatten(self.export()))
+        for key in self._written.keys() - current.keys():
+            # removed entries: empty blob / NaN, which readers turn into None
+            current[key] = b"" if isinstance(self._written[key], bytes) else None
+        for key, value in current.items():
+            # frames are immutable bytes, an identity check is enough
+            last = self._written.get(key, self)
+            if last is value or (not isinstance(value, bytes) and last == value):
+                continue
+            try:
+                if isinstance(value, bytes):
+                    self.store.put_blob(key, value)
+                else:
+                    self.store.put_value(key, value)
+            except ValueError as e:
+                applog.error(log, "store write failed", key=key, error=e)
+                if isinstance(value, bytes) and key in self.store._blob_index:
+                    # an oversized frame: workers drop the old one rather
+                    # than keep serving it as if it were current
+                    self.store.put_blob(key, b"")
+            self._written[key] = value
+            dirty = True
+        if dirty:
+            self.store.bump_generation()
+
+    def _run(self):
+        while True:
+            self.changed.wait(self.interval)
+            self.changed.clear()
+            self.write()
+
+
+class StoreReader:
+    """Worker side: copies changed entries into the local state via apply()."""
+
+    def __init__(self, store, apply, interval=0.02):
+        self.store = store
+        self.apply = apply
+        self.interval = interval
+        self._seen = {}
+        self._generation = None
+
+    def start(self):
+        self.sync()
+        threading.Thread(target=self._run, daemon=True, name="store-reader").start()
+
+    def sync(self):
+        gen = self.store.generation()
+        if gen == self._generation:
+            return
+        self._generation = gen
+        changed = self.store.read_changed(self._seen)
+        if changed:
+            self.apply(_unflatten(changed))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sync()
+
+
+# ================= COMMANDS =================
+
+class CommandServer:
+    """Ingest side: runs whitelisted commands for worker processes."""
+
+    def __init__(self, address, authkey, commands):
+        self.address = address
+        self.authkey = authkey
+        self.commands = commands
+
+    def start(self):
+        self.listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, daemon=True, name="command-server").start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                applog.warning(log, "command accept failed", error=e)
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    name, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, self.commands[name](*args)))
+                except Exception as e:
+                    conn.send((False, f"{type(e).__name__}: {e}"))
+
+
+class CommandClient:
+    """Worker side: one connection per thread, reconnected on failure."""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def call(self, name, *args):
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = Client(self.address, authkey=self.authkey)
+            try:
+                conn.send((name, args))
+                ok, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                self._local.conn = None
+                if attempt:
+                    raise
+        if not ok:
+            raise RuntimeError(result)
+        return result
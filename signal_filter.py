@@ -0,0 +1,143 @@
+"""Filtering for the ultrasonic distance readings.
+
+Raw readings are noisy and now and then plain garbage (0, a few metres, a
+NaN from a missed echo). DistanceFilter cleans them up one sample at a
+time:
+
+1. range check: values outside [MIN_CM, MAX_CM] are dropped;
+2. Hampel test: a reading further than K scaled MADs (and at least
+   MIN_DEVIATION cm) from the median of the last WINDOW readings is
+   rejected as a spike;
+3. on an accepted reading the estimate becomes the rolling median of the
+   window or, with kalman=True, a 1-D Kalman filter (constant level) fed
+   the accepted readings. A rejected reading leaves the estimate alone.
+
+Rejected readings still enter the window, so a real step in the level
+(the tank being refilled) is accepted once most of the window agrees
+with it instead of being rejected forever.
+
+Each update costs O(WINDOW) on a fixed ring buffer, i.e. constant per
+sample however long the stream runs. filter_batch() does steps 1-3 for a
+whole series at once with numpy, for recomputing history; it gives the
+same results as feeding the samples one by one. numpy is only imported
+there, so the streaming filter stays cheap to import.
+"""
+import bisect
+import collections
+
+WINDOW = 5
+K = 3.0                 # MADs
+MIN_DEVIATION = 2.0     # cm; below this a reading is never an outlier
+MIN_CM = 2.0            # HC-SR04 style sensors can't measure closer ...
+MAX_CM = 400.0          # ... or further than this
+MAD_SCALE = 1.4826      # MAD -> standard deviation for normal noise
+KALMAN_Q = 0.05         # process variance (cm^2 per sample): how fast the level may move
+KALMAN_R = 4.0          # measurement variance (cm^2)
+
+
+class Kalman1D:
+    __slots__ = ("q", "r", "x", "p")
+
+    def __init__(self, q=KALMAN_Q, r=KALMAN_R):
+        self.q = q
+        self.r = r
+        self.x = None
+        self.p = None
+
+    def update(self, z):
+        if self.x is None:
+            self.x, self.p = z, self.r
+            return z
+        p = self.p + self.q
+        gain = p / (p + self.r)
+        self.x += gain * (z - self.x)
+        self.p = (1 - gain) * p
+        return self.x
+
+
+def _median(sorted_values):
+    n = len(sorted_values)
+    mid = n // 2
+    return sorted_values[mid] if n % 2 else (sorted_values[mid - 1] + sorted_values[mid]) / 2
+
+
+class DistanceFilter:
+    def __init__(self, window=WINDOW, k=K, min_deviation=MIN_DEVIATION,
+                 min_cm=MIN_CM, max_cm=MAX_CM, kalman=False):
+        self.k = k
+        self.min_deviation = min_deviation
+        self.min_cm = min_cm
+        self.max_cm = max_cm
+        self._ring = collections.deque(maxlen=window)   # arrival order
+        self._sorted = []                               # same values, sorted
+        self._kalman = Kalman1D() if kalman else None
+        self.value = None     # current estimate
+        self.rejected = 0
+
+    def update(self, raw):
+        """-> (estimate, accepted). The estimate is unchanged for rejected readings."""
+        if not self.min_cm <= raw <= self.max_cm:   # also false for NaN
+            self.rejected += 1
+            return self.value, False
+
+        if len(self._ring) == self._ring.maxlen:
+            self._sorted.pop(bisect.bisect_left(self._sorted, self._ring[0]))
+        self._ring.append(raw)
+        bisect.insort(self._sorted, raw)
+
+        med = _median(self._sorted)
+        mad = _median(sorted(abs(v - med) for v in self._sorted))
+        if abs(raw - med) > max(self.k * MAD_SCALE * mad, self.min_deviation):
+            self.rejected += 1
+            accepted = False
+        else:
+            accepted = True
+        if accepted:
+            self.value = med if self._kalman is None else self._kalman.update(raw)
+        return self.value, accepted
+
+
+def filter_batch(values, window=WINDOW, k=K, min_deviation=MIN_DEVIATION,
+                 min_cm=MIN_CM, max_cm=MAX_CM, kalman=False):
+    """Vectorized DistanceFilter over a whole series.
+
+    Returns (estimates, accepted): float arrays of len(values), estimate NaN
+    until the first valid reading."""
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    valid = (values >= min_cm) & (values <= max_cm)
+    v = values[valid]
+    estimates = np.full(len(values), np.nan)
+    accepted = np.zeros(len(values), dtype=bool)
+    if not len(v):
+        return estimates, accepted
+
+    # trailing windows over the valid readings, NaN-padded at the start
+    padded = np.concatenate([np.full(window - 1, np.nan), v])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+    med = np.nanmedian(windows, axis=1)
+    mad = np.nanmedian(np.abs(windows - med[:, None]), axis=1)
+    ok = np.abs(v - med) <= np.maximum(k * MAD_SCALE * mad, min_deviation)
+
+    if kalman:
+        # inherently sequential; a plain loop over the accepted readings
+        f = Kalman1D()
+        est = np.empty(len(v))
+        current = np.nan
+        for i in range(len(v)):
+            if ok[i]:
+                current = f.update(v[i])
+            est[i] = current
+    else:
+        est = np.where(ok, med, np.nan)   # rejected: keep the previous estimate
+
+    idx = np.flatnonzero(valid)
+    estimates[idx] = est
+    accepted[idx] = ok
+    # invalid and rejected readings keep the previous estimate, like the streaming filter
+    filled = np.where(np.isnan(estimates), -1, np.arange(len(estimates)))
+    filled = np.maximum.accumulate(filled)
+    has = filled >= 0
+    estimates[has] = estimates[filled[has]]
+    return estimates, accepted
@@ -0,0 +1,160 @@
+"""Last-known device state on disk, so a restarted dashboard has something
+to show before the devices answer.
+
+The state is a dict whose values are numbers, None, bytes (camera frames)
+or one level of nested dicts of those. On disk it is a compact binary file:
+
+    header  "<4sHHId"   magic, format version, reserved, entry count, created
+    index   count x "<48sB7xdQQ"   key, kind, number, blob offset, blob length
+    blobs   raw bytes (frames as received, no re-encoding)
+
+Nested keys are flattened to "outer/inner". Files are written to a temp
+name, fsynced and renamed, so a crash never leaves a half-written snapshot.
+Restore maps the file and slices the blobs straight out of the mapping.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+import applog
+
+MAGIC = b"WSNP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHId")
+ENTRY = struct.Struct("<48sB7xdQQ")
+KEY_SIZE = 48
+
+KIND_NONE, KIND_FLOAT, KIND_INT, KIND_BLOB = range(4)
+
+log = applog.get_logger("snapshot")
+
+
+def _flatten(state):
+    for key, value in state.items():
+        if isinstance(value, dict):
+            for sub, v in value.items():
+                yield f"{key}/{sub}", v
+        else:
+            yield key, value
+
+
+def save(path, state):
+    entries = []
+    blobs = []
+    offset = HEADER.size
+    items = list(_flatten(state))
+    offset += ENTRY.size * len(items)
+    for key, value in items:
+        raw_key = key.encode()
+        if len(raw_key) > KEY_SIZE:
+            raise ValueError(f"snapshot key too long: {key}")
+        if value is None:
+            entries.append(ENTRY.pack(raw_key, KIND_NONE, 0.0, 0, 0))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            entries.append(ENTRY.pack(raw_key, KIND_BLOB, 0.0, offset, len(value)))
+            blobs.append(value)
+            offset += len(value)
+        elif isinstance(value, bool) or isinstance(value, int):
+            entries.append(ENTRY.pack(raw_key, KIND_INT, 0.0, int(value), 0))
+        else:
+            entries.append(ENTRY.pack(raw_key, KIND_FLOAT, float(value), 0, 0))
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(entries), time.time()))
+        f.write(b"".join(entries))
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def load(path):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, _, count, created = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                applog.warning(log, "unknown snapshot format", path=path)
+                return None
+            state = {}
+            pos = HEADER.size
+            for _ in range(count):
+                raw_key, kind, number, off, length = ENTRY.unpack_from(mm, pos)
+                pos += ENTRY.size
+                if kind == KIND_BLOB:
+                    value = mm[off:off + length]
+                elif kind == KIND_INT:
+                    value = off
+                elif kind == KIND_FLOAT:
+                    value = number
+                else:
+                    value = None
+                key = raw_key.rstrip(b"\0").decode()
+                outer, sep, inner = key.partition("/")
+                if sep:
+                    state.setdefault(outer, {})[inner] = value
+                else:
+                    state[key] = value
+            return state
+
+
+class Snapshotter:
+    """Writes export() to path every `interval` seconds on a daemon thread.
+
+    export() is expected to take the state lock only long enough to copy the
+    dicts; frames are immutable bytes, so the copy shares them with the live
+    state (copy-on-write) and serialization runs with the lock released.
+    """
+
+    def __init__(self, path, export, interval=30.0):
+        self.path = path
+        self.export = export
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="snapshot")
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.write()
+
+    def write(self):
+        state = self.export()
+        if state == self._last:
+            return
+        start = time.perf_counter()
+        try:
+            save(self.path, state)
+        except OSError as e:
+            applog.error(log, "snapshot failed", path=self.path, error=e)
+            return
+        self._last = state
+        applog.debug(log, "snapshot written", path=self.path, seconds=time.perf_counter() - start)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
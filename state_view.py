@@ -0,0 +1,93 @@
+"""Versioned, pre-serialized view of the dashboard state for /state.
+
+A builder thread calls build() -> {key: entry dict} whenever it is woken
+(changed()) and at least every `interval` seconds. Each entry is compared
+with the previous one; a changed entry gets the next version number and
+is serialized to JSON right there. Requests never build or serialize
+entries, they only join cached fragments:
+
+    GET /state                      every entry
+    GET /state?since=V&epoch=E      only entries changed after version V
+
+`epoch` identifies this process's version sequence. A client holding a
+version from another process (restart, or another gunicorn worker) gets a
+full response instead of a wrong delta.
+"""
+import json
+import os
+import threading
+import time
+
+import applog
+
+log = applog.get_logger("state_view")
+
+
+class StateView:
+    def __init__(self, build, interval=1.0):
+        self.build = build
+        self.interval = interval
+        self.epoch = f"{os.getpid():x}{int(time.time() * 1000):x}"
+        self.version = 0
+        self._entries = {}    # key -> last entry (for comparison)
+        self._fragments = {}  # key -> (version, serialized entry)
+        self._full = None
+        self._removed = 0     # version of the last removal; older deltas can't express it
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="state-view")
+        self._thread.start()
+        self._started.wait(5)
+
+    def changed(self):
+        self._wake.set()
+
+    def refresh(self):
+        entries = self.build()
+        with self._lock:
+            dirty = False
+            for key, entry in entries.items():
+                if self._entries.get(key) == entry:
+                    continue
+                self.version += 1
+                self._entries[key] = entry
+                self._fragments[key] = (self.version, json.dumps(entry, separators=(",", ":")))
+                dirty = True
+            for key in self._entries.keys() - entries.keys():
+                del self._entries[key]
+                del self._fragments[key]
+                self.version += 1
+                self._removed = self.version
+                dirty = True
+            if dirty or self._full is None:
+                self._full = self._render(self._fragments.items(), True)
+
+    def response(self, since=None, epoch=None):
+        """-> JSON bytes: everything, or only what changed after `since`."""
+        with self._lock:
+            if since is None or epoch != self.epoch or not self._removed <= since <= self.version:
+                return self._full
+            changed = [(k, f) for k, f in self._fragments.items() if f[0] > since]
+            return self._render(changed, False)
+
+    def _render(self, fragments, full):
+        body = ",".join(f"{json.dumps(key)}:{frag}" for key, (_, frag) in fragments)
+        return (f'{{"version":{self.version},"epoch":"{self.epoch}",'
+                f'"full":{"true" if full else "false"},"devices":{{{body}}}}}').encode()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                applog.error(log, "state view refresh failed", error=e)
+            self._started.set()
+            self._wake.wait(self.interval)
@@ -0,0 +1,136 @@
+"""Build a time-lapse from archived frames.
+
+    python timelapse.py archive ESP32_CAM_1 --start "2026-10-01 06:00" --end "2026-10-02 06:00" -o day.avi
+    python timelapse.py archive ESP32_CAM_1 --every 12 --grid -o day.jpg
+
+Frames are streamed from the archive and decoded on a thread pool
+(cv2.imdecode releases the GIL) with a bounded number in flight, so memory
+stays flat no matter how long the range is.
+"""
+import argparse
+import collections
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import frame_archive
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"bad time: {value}")
+
+
+def decode(item, size):
+    ts, payload = item
+    img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return ts, None
+    if size is not None and (img.shape[1], img.shape[0]) != size:
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return ts, img
+
+
+def decoded(frames, size, workers):
+    # ordered parallel map with at most 2*workers frames in flight
+    with ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for item in frames:
+            pending.append(pool.submit(decode, item, size))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def every_nth(frames, n):
+    for i, item in enumerate(frames):
+        if i % n == 0:
+            yield item
+
+
+def stamp(img, ts):
+    text = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+    cv2.putText(img, text, (8, img.shape[0] - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+
+
+def write_video(images, out, fps):
+    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+    writer = None
+    count = 0
+    for ts, img in images:
+        if img is None:
+            continue
+        if writer is None:
+            writer = cv2.VideoWriter(out, fourcc, fps, (img.shape[1], img.shape[0]))
+        stamp(img, ts)
+        writer.write(img)
+        count += 1
+    if writer is not None:
+        writer.release()
+    return count
+
+
+def write_grid(images, out, cols):
+    tiles = [(ts, img) for ts, img in images if img is not None]
+    if not tiles:
+        return 0
+    h, w = tiles[0][1].shape[:2]
+    rows = (len(tiles) + cols - 1) // cols
+    canvas = np.zeros((rows * h, cols * w, 3), np.uint8)
+    for i, (ts, img) in enumerate(tiles):
+        stamp(img, ts)
+        r, c = divmod(i, cols)
+        canvas[r * h:(r + 1) * h, c * w:(c + 1) * w] = img
+    cv2.imwrite(out, canvas)
+    return len(tiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="archive root (WEB_APP_ARCHIVE)")
+    parser.add_argument("camera", nargs="?", help="camera id, omit to list cameras")
+    parser.add_argument("--start", type=parse_time)
+    parser.add_argument("--end", type=parse_time)
+    parser.add_argument("-o", "--out", default="timelapse.avi")
+    parser.add_argument("--fps", type=float, default=24)
+    parser.add_argument("--every", type=int, default=1, help="keep every Nth frame")
+    parser.add_argument("--width", type=int, help="resize frames to this width")
+    parser.add_argument("--grid", action="store_true", help="write an image grid instead of a video")
+    parser.add_argument("--cols", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    if args.camera is None:
+        for cam in frame_archive.cameras(args.archive):
+            print(cam)
+        return
+
+    # grid tiles default to thumbnails
+    width = args.width or (160 if args.grid else None)
+    size = (width, width * 3 // 4) if width else None
+
+    frames = frame_archive.iter_frames(args.archive, args.camera, args.start, args.end)
+    if args.every > 1:
+        frames = every_nth(frames, args.every)
+    images = decoded(frames, size, args.workers)
+
+    start = time.time()
+    if args.grid:
+        count = write_grid(images, args.out, args.cols)
+    else:
+        count = write_video(images, args.out, args.fps)
+    print(f"{count} frames -> {args.out} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
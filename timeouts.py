@@ -0,0 +1,75 @@
+"""Per-device timeouts computed from observed round trips, the way TCP
+computes its retransmission timeout (RFC 6298):
+
+    SRTT   <- (1 - ALPHA) * SRTT + ALPHA * RTT
+    RTTVAR <- (1 - BETA) * RTTVAR + BETA * |SRTT - RTT|
+    RTO     = SRTT + K * RTTVAR, clamped to [minimum, maximum]
+
+A fast device ends up with a short timeout and fails fast; a slow or jittery
+one gets a longer timeout instead of flapping to offline. After a timeout
+the value doubles (up to maximum) until the next answer comes in.
+"""
+import threading
+
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+
+class RttEstimator:
+    __slots__ = ("srtt", "rttvar", "backoff")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.backoff = 1
+
+    def rto(self):
+        return self.srtt + K * self.rttvar
+
+
+class AdaptiveTimeouts:
+    def __init__(self, initial, minimum, maximum):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._est = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, rtt):
+        if rtt is None or rtt >= self.maximum:
+            return
+        with self._lock:
+            est = self._est.get(key)
+            if est is None:
+                est = self._est[key] = RttEstimator()
+            est.observe(rtt)
+
+    def timed_out(self, key):
+        with self._lock:
+            est = self._est.get(key)
+            if est is None:
+                est = self._est[key] = RttEstimator()
+            est.backoff = min(est.backoff * 2, 64)
+
+    def timeout(self, key):
+        with self._lock:
+            est = self._est.get(key)
+            if est is None:
+                return self.initial
+            base = self.initial if est.srtt is None else est.rto()
+            return min(self.maximum, max(self.minimum, base) * est.backoff)
+
+    def snapshot(self):
+        with self._lock:
+            keys = list(self._est)
+        return {key: round(self.timeout(key), 3) for key in keys}
@@ -5,6 +5,9 @@ import threading
 import time
 import random
 import io
+from chunked import Reassembler
+from request_gate import RequestGate
+from timeouts import AdaptiveTimeouts
 
 BROKER = "192.168.1.100"
 PORT = 1883
@@ -23,7 +26,7 @@ last_heartbeat = None
 last_heartbeat_time = None
 heartbeat_lock = threading.Lock()
 heartbeat_continuous = False
-HEARTBEAT_TIMEOUT = 3  # seconds
+HEARTBEAT_PERIOD = 2  # seconds
 
 # === Camera ===
 CAM_REQ = "esp32/picture/request"
@@ -31,14 +34,42 @@ CAM_RESP = "esp32/picture/response"
 latest_image = None
 image_lock = threading.Lock()
 camera_continuous = False
-CAMERA_TIMEOUT = 2  # seconds
+CAMERA_PERIOD = 0.5  # seconds
 last_image_time = None
+reassembler = Reassembler()
+# the ESP32 gets at most one picture request in flight, 1/s sustained
+camera_gate = RequestGate(rate=1.0, burst=2)
+
+# === Timeouts ===
+# how long to wait for an answer, learned per request kind from the RTT;
+# a reply counts as stale after one request period plus that timeout
+timeouts = AdaptiveTimeouts(initial=2, minimum=0.3, maximum=8)
+sent_at = {}
+
+def sent(kind):
+    sent_at[kind] = time.time()
+
+def answered(kind):
+    t = sent_at.pop(kind, None)
+    if t is not None:
+        timeouts.observe(kind, time.time() - t)
+
+def wait_for(kind, done):
+    limit = timeouts.timeout(kind)
+    start = time.time()
+    while time.time() - start < limit:
+        result = done()
+        if result is not None:
+            return result
+        time.sleep(0.05)
+    timeouts.timed_out(kind)
+    return None
 
 # === Flask app ===
 app = Flask(__name__)
 
 # === MQTT setup ===
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+client = None
 
 def on_message(client, userdata, msg):
     global last_distance, last_heartbeat, last_heartbeat_time, latest_image, last_image_time
@@ -47,26 +78,39 @@ def on_message(client, userdata, msg):
         dist = struct.unpack('f', msg.payload)[0]
         with distance_lock:
             last_distance = dist
+        answered("ultrasonic")
     # Heartbeat
     elif msg.topic == HEART_RESP:
         with heartbeat_lock:
             last_heartbeat = msg.payload.decode()
             last_heartbeat_time = time.time()
+        answered("heartbeat")
     # Camera
     elif msg.topic == CAM_RESP:
+        # single-message JPEG or one chunk of a larger frame
+        frame = reassembler.feed(CAM_RESP, msg.payload)
+        if frame is None:
+            return
+        camera_gate.complete(CAM_RESP)
+        answered("picture")
         with image_lock:
-            latest_image = msg.payload
+            latest_image = frame
             last_image_time = time.time()
 
-client.on_message = on_message
-client.connect(BROKER, PORT)
-client.subscribe([(ULTRASONIC_RESP,0), (HEART_RESP,0), (CAM_RESP,0)])
-client.loop_start()
+def init_mqtt():
+    global client
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_message = on_message
+    client.connect(BROKER, PORT)
+    client.subscribe([(ULTRASONIC_RESP,0), (HEART_RESP,0), (CAM_RESP,0)])
+    client.loop_start()
+    start_loops()
 
 # === Background loops ===
 def ultrasonic_loop():
     while True:
         if ultrasonic_continuous:
+            sent("ultrasonic")
             client.publish(ULTRASONIC_REQ, "get")
         time.sleep(0.5)
 
@@ -74,19 +118,24 @@ def heartbeat_loop():
     while True:
         if heartbeat_continuous:
             payload = f"alive:{int(time.time())}:{random.randint(1000,9999)}"
+            sent("heartbeat")
             client.publish(HEART_REQ, payload)
-        time.sleep(2)  # heartbeat every 2s
+        time.sleep(HEARTBEAT_PERIOD)
 
 def camera_loop():
     while True:
         if camera_continuous:
-            client.publish(CAM_REQ, "get")
-        time.sleep(0.5)  # camera request every 0.5s
+            camera_gate.request(CAM_REQ, publish_camera)
+        time.sleep(CAMERA_PERIOD)
 
-# Start threads
-threading.Thread(target=ultrasonic_loop, daemon=True).start()
-threading.Thread(target=heartbeat_loop, daemon=True).start()
-threading.Thread(target=camera_loop, daemon=True).start()
+def publish_camera():
+    sent("picture")
+    client.publish(CAM_REQ, "get")
+
+def start_loops():
+    threading.Thread(target=ultrasonic_loop, daemon=True).start()
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+    threading.Thread(target=camera_loop, daemon=True).start()
 
 # === Routes ===
 @app.route("/")
@@ -96,13 +145,11 @@ def index():
 # --- Ultrasonic ---
 @app.route("/request_once")
 def request_once():
+    sent("ultrasonic")
     client.publish(ULTRASONIC_REQ, "get")
-    start = time.time()
-    while time.time() - start < 3:
-        with distance_lock:
-            if last_distance is not None:
-                return jsonify({"distance": last_distance})
-        time.sleep(0.05)
+    distance = wait_for("ultrasonic", lambda: last_distance)
+    if distance is not None:
+        return jsonify({"distance": distance})
     return jsonify({"distance": None, "error": "Timeout"})
 
 @app.route("/start_continuous_ultrasonic")
@@ -133,20 +180,21 @@ def send_heartbeat():
         last_heartbeat_time = None
 
     payload = f"alive:{int(time.time())}:{random.randint(1000,9999)}"
+    sent("heartbeat")
     client.publish(HEART_REQ, payload)
 
-    # Wait up to 2 seconds for reply
-    start = time.time()
-    while time.time() - start < 2:
+    def reply():
         with heartbeat_lock:
             if last_heartbeat_time is not None:
-                return jsonify({
+                return {
                     "status": "ok",
                     "reply": last_heartbeat,
                     "time": last_heartbeat_time
-                })
-        time.sleep(0.05)
+                }
 
+    result = wait_for("heartbeat", reply)
+    if result is not None:
+        return jsonify(result)
     return jsonify({"status": "timeout"})
 
 
@@ -172,7 +220,7 @@ def get_heartbeat():
             return jsonify({"status": "no_reply"})
 
         age = time.time() - last_heartbeat_time
-        if age > HEARTBEAT_TIMEOUT:
+        if age > HEARTBEAT_PERIOD + timeouts.timeout("heartbeat"):
             return jsonify({"status": "timeout"})
 
         return jsonify({
@@ -186,7 +234,11 @@ def get_heartbeat():
 # --- Camera ---
 @app.route("/request_image")
 def request_image():
-    client.publish(CAM_REQ, "get")
+    status, entry = camera_gate.request(CAM_REQ, publish_camera)
+    if status == "rate_limited":
+        return f"Too many image requests, retry in {entry:.1f}s", 429
+    if status == "coalesced":
+        return "Image request already in flight"
     return "Image request sent"
 
 @app.route("/start_continuous_camera")
@@ -207,11 +259,14 @@ def get_image():
         if latest_image is None or last_image_time is None:
             return "No image", 404
 
-        if time.time() - last_image_time > CAMERA_TIMEOUT:
+        # frames can't arrive faster than the gate lets requests out
+        period = max(CAMERA_PERIOD, 1 / camera_gate.rate)
+        if time.time() - last_image_time > period + timeouts.timeout("picture"):
             return "Image timeout", 404
 
         return send_file(io.BytesIO(latest_image), mimetype="image/png")
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    init_mqtt()  # ← only run once, in main process
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
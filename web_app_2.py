@@ -3,14 +3,27 @@ import paho.mqtt.client as mqtt
 import threading
 import time
 import io
+import os
+import atexit
 import struct
+import applog
+import snapshot
+from chunked import Reassembler
+from request_gate import RequestGate
+from signal_filter import DistanceFilter
 
 BROKER = "192.168.1.163"
 PORT = 1883
 
+# last state, written every SNAPSHOT_INTERVAL s and on shutdown, loaded on boot ("" disables)
+SNAPSHOT_PATH = os.environ.get("WEB_APP_SNAPSHOT", "web_app_2_state.snap")
+SNAPSHOT_INTERVAL = 30
+
 HEARTBEAT_TIMEOUT = 8
 IMAGE_TIMEOUT = 2  # 2 seconds timeout for images
 
+log = applog.get_logger("web_app_2")
+
 # ================= DEVICES =================
 
 CAMERAS = {
@@ -36,9 +49,13 @@ images = {}
 image_time = {}
 heartbeats = {}
 hb_request_time = {}
-water_value = None
+water_value = None   # filtered (rolling median, spikes rejected)
 water_time = None
+water_filter = DistanceFilter()
 lock = threading.Lock()
+reassembler = Reassembler()
+# /manual requests: coalesced per device+kind and token-bucket limited
+gate = RequestGate()
 
 # ================= MQTT =================
 
@@ -49,25 +66,34 @@ def on_message(client, userdata, message):
     global water_value, water_time
     topic = message.topic
     payload = message.payload
-    print(f"Got msg at topic: {topic}")
+    applog.debug(log, "mqtt message", topic=topic, size=len(payload))
+    # the gate is released by complete replies only: a whole frame, a reading
+    # that parses, a heartbeat; not by every chunk or unrelated topic
     with lock:
         for cam_id, cam in CAMERAS.items():
             if topic == cam["pic_resp"]:
-                images[cam_id] = payload
-                image_time[cam_id] = time.time()
+                # single-message JPEG or one chunk of a larger frame
+                frame = reassembler.feed(cam_id, payload)
+                if frame is not None:
+                    images[cam_id] = frame
+                    image_time[cam_id] = time.time()
+                    gate.complete(topic)
                 return
             if topic == cam["hb_resp"]:
                 heartbeats[cam_id] = time.time()
+                gate.complete(topic)
                 return
         if topic == WATER["resp"]:
             try:
-                water_value = struct.unpack("f", payload)[0]
+                water_value, _ = water_filter.update(struct.unpack("f", payload)[0])
                 water_time = time.time()
             except:
-                pass
+                return
+            gate.complete(topic)
             return
         if topic == WATER["hb_resp"]:
             heartbeats[WATER["id"]] = time.time()
+            gate.complete(topic)
 
 # client.on_message = on_message
 # client.connect(BROKER, PORT)
@@ -79,6 +105,7 @@ def on_message(client, userdata, message):
 
 def init_mqtt():
     global client
+    start_snapshots()
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_message = on_message
     client.connect(BROKER, PORT)
@@ -88,6 +115,45 @@ def init_mqtt():
     client.subscribe(subs)
     client.loop_start()
 
+# ================= SNAPSHOT =================
+
+def export_state():
+    # shallow copies only: frames are immutable bytes shared with the live state
+    with lock:
+        return {
+            "images": dict(images),
+            "image_time": dict(image_time),
+            "heartbeats": dict(heartbeats),
+            "hb_request_time": dict(hb_request_time),
+            "water_value": water_value,
+            "water_time": water_time,
+        }
+
+def restore_state(state):
+    global water_value, water_time
+    with lock:
+        images.update(state.get("images", {}))
+        image_time.update(state.get("image_time", {}))
+        heartbeats.update(state.get("heartbeats", {}))
+        # not hb_request_time: a heartbeat that answered a request before the
+        # restart would show "ack" until the next update_all
+        water_value = state.get("water_value")
+        water_time = state.get("water_time")
+
+snapshotter = None
+
+def start_snapshots():
+    global snapshotter
+    if not SNAPSHOT_PATH or snapshotter is not None:
+        return
+    state = snapshot.load(SNAPSHOT_PATH)
+    if state:
+        restore_state(state)
+        applog.info(log, "snapshot restored", path=SNAPSHOT_PATH, images=len(images))
+    snapshotter = snapshot.Snapshotter(SNAPSHOT_PATH, export_state, SNAPSHOT_INTERVAL)
+    snapshotter.start()
+    atexit.register(snapshotter.stop)
+
 # ================= FLASK =================
 
 app = Flask(__name__)
@@ -122,10 +188,12 @@ def get_heartbeat():
 
             ts_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(ts))
             
-            print(f"DEBUG: {cam_id} request time: {req_t:.3f}, response time: {ts:.3f} and diff: {(ts-req_t):.3f}s")
+            applog.debug(log, "heartbeat", device=cam_id, request=req_t, response=ts, diff=ts - req_t)
 
             # result[cam_id] = "ack" if ts and now - ts < HEARTBEAT_TIMEOUT else "offline"
-            if (ts-req_t) < HEARTBEAT_TIMEOUT:
+            # a heartbeat from before the request (restored from a snapshot,
+            # or an answer to an earlier ping) doesn't answer it
+            if 0 <= ts - req_t < HEARTBEAT_TIMEOUT:
                 result[cam_id] = f"ack {ts_str}" 
             else:
                 result[cam_id] = f"offline {ts_str}"
@@ -141,8 +209,8 @@ def get_heartbeat():
             result[wl_id] = "offline"
         else:
             res_wl_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(res_wl))
-            print(f"DEBUG: {wl_id} request time: {req_wl:.3f}, response time: {res_wl:.3f} and diff: {(res_wl - req_wl):.3f}s")
-            if (res_wl - req_wl) < HEARTBEAT_TIMEOUT:
+            applog.debug(log, "heartbeat", device=wl_id, request=req_wl, response=res_wl, diff=res_wl - req_wl)
+            if 0 <= res_wl - req_wl < HEARTBEAT_TIMEOUT:
                 result[wl_id] = f"ack {res_wl_str}"
             else:
                 result[wl_id] = f"offline {res_wl_str}"
@@ -222,8 +290,10 @@ def update_all():
 def manual():
     data = request.json
     req_topic = data["req"]
-    client.publish(req_topic, "get")
-    return jsonify({"status": "sent"})
+    status, entry = gate.request(req_topic, lambda: client.publish(req_topic, "get"))
+    if status == "rate_limited":
+        return jsonify({"status": status, "retry_after": round(entry, 2)}), 429
+    return jsonify({"status": status})
 
 # ================= MAIN =================
 
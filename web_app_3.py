@@ -1,18 +1,78 @@
-from flask import Flask, render_template, jsonify, send_file, request
+from flask import Flask, render_template, jsonify, send_file, request, g, Response
 import paho.mqtt.client as mqtt
 import threading
 import time
 import io
+import os
+import atexit
 import struct
+import metrics
+import applog
+import snapshot
+import shared_state
+from frame_pipeline import FramePipeline, looks_like_jpeg
+from ingest_queue import Lane
+from change_detect import ChangeDetector
+from frame_archive import ArchiveWriter
+from chunked import MAX_FRAME, Reassembler
+import publisher
+import profiler
+from request_gate import RequestGate
+from device_stats import DeviceStats
+from timeouts import AdaptiveTimeouts
+from actuators import Actuator, ActuatorEngine
+from devices import Device, Registry
+from state_view import StateView
+from mosaic import Mosaic
+from signal_filter import DistanceFilter
+from rules import HysteresisRule, RuleEngine
 
 BROKER = "192.168.1.163"
 PORT = 1883
-
+# fixed id + clean_session=False: the broker keeps our subscriptions and
+# queues QoS 1 messages while the dashboard is restarting
+CLIENT_ID = "web_app_3"
+# WEB_APP_SPLIT=1: picture requests/responses get their own connection so
+# JPEG traffic never queues in front of heartbeat acks and actuator commands
+SPLIT_CONNECTIONS = os.environ.get("WEB_APP_SPLIT", "0") == "1"
+
+# last state, written every SNAPSHOT_INTERVAL s and on shutdown, loaded on boot ("" disables)
+SNAPSHOT_PATH = os.environ.get("WEB_APP_SNAPSHOT", "web_app_3_state.snap")
+SNAPSHOT_INTERVAL = 30
+
+# distance readings: rolling median + outlier rejection, WEB_APP_KALMAN=1 adds a Kalman stage
+WATER_KALMAN = os.environ.get("WEB_APP_KALMAN", "0") == "1"
+
+# changed frames are appended here for timelapse.py ("" disables)
+ARCHIVE_DIR = os.environ.get("WEB_APP_ARCHIVE", "")
+
+# ================= DEPLOYMENT =================
+# single: MQTT and HTTP in one process      python web_app_3.py
+# ingest: owns MQTT, shares state, no HTTP  WEB_APP_ROLE=ingest python web_app_3.py
+# worker: HTTP only, any number of them     WEB_APP_ROLE=worker gunicorn -w 4 -b 0.0.0.0:5000 web_app_3:app
+# (workers attach at import, so don't run gunicorn with --preload)
+# ingest and workers need the same secret WEB_APP_AUTHKEY: the command
+# socket can switch the pump, so there is no default key.
+ROLE = os.environ.get("WEB_APP_ROLE", "single")
+STORE_NAME = "web_app_3_state"
+STORE_FRAME_SIZE = MAX_FRAME   # any frame the reassembler accepts fits a slot
+STORE_WAIT = 30   # s a worker waits for the ingest process to create the store
+COMMAND_ADDRESS = ("127.0.0.1", 5001)
+COMMAND_AUTHKEY = os.environ.get("WEB_APP_AUTHKEY", "").encode()
+
+# per-device timeouts adapt to each device's RTT within [min, max];
+# WAIT_INITIAL is used until a device has answered once
 HEARTBEAT_TIMEOUT = 8
-IMAGE_TIMEOUT = 2  # 2 seconds timeout for images
+WAIT_INITIAL = 4
+WAIT_MIN = 0.5
 
 # ================= DEVICES =================
 
+# one publish here pings every device that subscribes to it; replies come
+# back on each device's own <id>/heartbeat/response
+FLEET_HB_REQ = "fleet/heartbeat/request"
+HB_RESP_WILDCARD = "+/heartbeat/response"
+
 CAMERAS = {
     f"ESP32_CAM_{i}": {
         "pic_req": f"ESP32_CAM_{i}/picture/request",
@@ -39,56 +99,202 @@ ACTUATOR = {
     "hb_resp": "ESP32_ACT_1/heartbeat/response",
 }
 PUMP_REQ_TOPIC = "ESP32_ACT_1/pump/digital/request"
+PUMP_RESP_TOPIC = "ESP32_ACT_1/pump/digital/response"
 LIGHT_REQ_TOPIC = "ESP32_ACT_1/light/digital/request"
-
-pump_state = 0   # 0 = OFF, 1 = ON
-light_state = 0
-
+LIGHT_RESP_TOPIC = "ESP32_ACT_1/light/digital/response"
+
+# one record per device, indexed by id and by every topic it uses
+devices = Registry()
+for _cam_id, _cam in CAMERAS.items():
+    devices.add(Device(_cam_id, "camera", _cam))
+devices.add(Device(WATER["id"], "water", {k: v for k, v in WATER.items() if k != "id"}))
+devices.add(Device(ACTUATOR["id"], "actuator", {k: v for k, v in ACTUATOR.items() if k != "id"}))
+water = devices[WATER["id"]]
+distance_filters = {dev.id: DistanceFilter(kalman=WATER_KALMAN) for dev in devices.of_kind("water")}
+
+# 0 = OFF, 1 = ON; `reported` stays None until the board acks a command.
+# active_low=True for relay boards where publishing 1 switches the load off.
+pump = Actuator("pump", PUMP_REQ_TOPIC, PUMP_RESP_TOPIC)
+light = Actuator("light", LIGHT_REQ_TOPIC, LIGHT_RESP_TOPIC)
+actuator_engine = ActuatorEngine(lambda topic, payload, qos: publish(topic, payload, qos, publisher.CONTROL),
+                                 [pump, light])
+
+# ================= RULES =================
+# WEB_APP_RULES=1: the pump follows the water level. The sensor looks down
+# at the surface, so a larger distance means less water.
+RULES_ENABLED = os.environ.get("WEB_APP_RULES", "0") == "1"
+PUMP_ON_DISTANCE = 40    # cm
+PUMP_OFF_DISTANCE = 20   # cm
+PUMP_MIN_ON = 10         # s
+PUMP_MIN_OFF = 30        # s
+PUMP_MAX_ON = 300        # s; fail-safe even with a working sensor
+PUMP_STALE_AFTER = 20    # s without a level reading -> pump off
+RULE_CHECK_INTERVAL = 1  # s between fail-safe checks
+RULE_POLL_INTERVAL = 5   # s between level requests while rules run
+
+rule_engine = RuleEngine(actuator_engine)
+if RULES_ENABLED:
+    rule_engine.add(HysteresisRule("pump_level", WATER["resp"], "pump", PUMP_ON_DISTANCE, PUMP_OFF_DISTANCE,
+                                   min_on=PUMP_MIN_ON, min_off=PUMP_MIN_OFF,
+                                   max_on=PUMP_MAX_ON, stale_after=PUMP_STALE_AFTER))
+
+
+log = applog.get_logger("web_app_3")
+
+# ================= METRICS =================
+
+# labelled by known device and topic role, never by the raw topic: the
+# heartbeat wildcard would let any publisher add label values
+MQTT_MESSAGES = metrics.counter("mqtt_messages_total", "MQTT messages received", ("device", "role"))
+MQTT_BYTES = metrics.counter("mqtt_payload_bytes_total", "MQTT payload bytes received", ("device", "role"))
+ON_MESSAGE_TIME = metrics.histogram("mqtt_on_message_seconds", "Time spent in on_message")
+LOCK_WAIT = metrics.histogram("state_lock_wait_seconds", "Time spent waiting for the state lock")
+DEVICE_RTT = metrics.histogram("device_rtt_seconds", "Request to response round trip", ("device", "kind"),
+                               buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0))
+HTTP_LATENCY = metrics.histogram("http_request_seconds", "HTTP handler latency", ("endpoint", "status"))
+DISTANCE_READINGS = metrics.counter("distance_readings_total", "Distance readings by filter outcome",
+                                    ("device", "outcome"))
+UNROUTED = metrics.counter("mqtt_unrouted_total", "MQTT messages on topics no device uses")
+REFRESHES = metrics.counter("fleet_refresh_total", "/update_all calls by outcome (run, shared, recent)",
+                            ("outcome",))
+FRAME_BYTES_SERVED = metrics.counter("frame_bytes_served_total", "JPEG bytes served", ("camera",))
 
 # ================= STATE =================
 
-images = {}
-image_time = {}
-heartbeats = {}
-hb_request_time = {}
-water_value = None
-water_time = None
-lock = threading.Lock()
+# per-device frames, readings and timestamps live on the records in `devices`
+lock = metrics.TimedLock(LOCK_WAIT)
+# per-device RTT quantiles, timeouts, jitter and frame sizes (/stats)
+stats = DeviceStats(request_timeout=HEARTBEAT_TIMEOUT)
+timeouts = AdaptiveTimeouts(WAIT_INITIAL, WAIT_MIN, HEARTBEAT_TIMEOUT)
+state_changed = threading.Event()  # wakes the shared store writer (ingest role)
+command_client = None  # set in worker processes
 
 # ================= MQTT =================
 
 # client = mqtt.Client()
 # client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 client = None
+bulk_client = None  # only with SPLIT_CONNECTIONS
+
+outbox = publisher.PriorityPublisher({
+    publisher.CONTROL: lambda: client,
+    publisher.HEARTBEAT: lambda: client,
+    publisher.BULK: lambda: bulk_client or client,
+})
+
+# /manual requests: coalesced per device+kind and token-bucket limited
+gate = RequestGate()
+
+def publish(topic, payload, qos=0, priority=None):
+    if priority is None:
+        priority = publisher.BULK if topic.endswith("/picture/request") else publisher.HEARTBEAT
+    outbox.publish(topic, payload, qos, priority)
+
 def on_message(client, userdata, message):
-    global water_value, water_time
+    start = time.perf_counter()
     topic = message.topic
-    payload = message.payload
-    print(f"Got msg at topic: {topic}")
+    dev, role = devices.route(topic)
+    act = actuator_engine.by_topic.get(topic) if dev is None else None
+    if dev is not None:
+        labels = (dev.id, role)
+    elif act is not None:
+        labels = (ACTUATOR["id"], act.name)
+    else:
+        labels = ("unknown", "unknown")
+    MQTT_MESSAGES.inc(*labels)
+    MQTT_BYTES.add(len(message.payload), *labels)
+    try:
+        with profiler.span("mqtt", topic):
+            dispatch(topic, dev, role, message.payload, message.retain, time.time())
+    finally:
+        ON_MESSAGE_TIME.observe(time.perf_counter() - start)
+
+def dispatch(topic, dev, role, payload, retained, received):
+    # Network thread: picture chunks are reassembled here (a copy into a
+    # preallocated buffer), everything else is queued by class and handled
+    # on that class's lane. Unknown topics are dropped.
+    if topic in actuator_engine.by_topic:
+        control_lane.submit(topic, payload, retained, received)
+        return
+    if role == "pic_resp":
+        # single-message JPEG or one chunk of a larger frame
+        frame = reassembler.feed(dev.id, payload)
+        if frame is not None:
+            # the request is answered once the whole frame is in, not per chunk
+            gate.complete(topic)
+            frames.submit(dev.id, frame, received)
+    elif role == "hb_resp":
+        gate.complete(topic)
+        control_lane.submit(topic, payload, retained, received)
+    elif role == "resp":
+        reading_lane.submit(topic, payload, retained, received)
+    else:
+        UNROUTED.inc()
+
+def handle_queued(topic, payload, retained, received):
+    try:
+        with profiler.span("ingest", topic):
+            handle_message(topic, payload, retained, received)
+    finally:
+        mark_changed()
+
+def mark_changed():
+    state_changed.set()
+    state_view.changed()
+
+def note_request(dev_id, kind, now, restart=False):
+    dev = devices[dev_id]
+    if kind == "heartbeat":
+        dev.hb_request_time = now
+        dev.hb_timeout = timeouts.timeout((dev_id, kind))
+    elif kind == "picture":
+        dev.pic_request_time = now
+    stats.sent(dev_id, kind, now, restart)
+
+def record_heartbeat(dev, now=None):
+    now = time.time() if now is None else now
+    dev.heartbeat = now
+    timeouts.observe((dev.id, "heartbeat"), stats.received(dev.id, "heartbeat", now))
+    if dev.hb_request_time is not None:
+        DEVICE_RTT.observe(now - dev.hb_request_time, dev.id, "heartbeat")
+
+def handle_message(topic, payload, retained=False, received=None):
+    # Retained messages are the broker's last-known values: good enough to
+    # show a frame or reading, but a retained heartbeat says nothing about
+    # whether the device is alive now. `received` is when on_message got
+    # it, so time spent queued doesn't count against the device.
+    received = time.time() if received is None else received
+    applog.debug(log, "mqtt message", topic=topic, size=len(payload))
+    if actuator_engine.handles(topic):
+        value = actuator_engine.on_ack(topic, payload)
+        if value is not None:   # only parsed acks close a rule's latency sample
+            rule_engine.on_ack(actuator_engine.by_topic[topic].name, value)
+        return
+    dev, role = devices.route(topic)
+    if dev is None:
+        return
+    reading = None
     with lock:
-        for cam_id, cam in CAMERAS.items():
-            if topic == cam["pic_resp"]:
-                images[cam_id] = payload
-                image_time[cam_id] = time.time()
-                return
-            if topic == cam["hb_resp"]:
-                heartbeats[cam_id] = time.time()
-                return
-        if topic == WATER["resp"]:
+        if role == "resp":
             try:
-                water_value = struct.unpack("f", payload)[0]
-                water_time = time.time()
+                raw = struct.unpack("f", payload)[0]
+                gate.complete(topic)
+                dev.value, accepted = distance_filters[dev.id].update(raw)
+                dev.raw_value = raw
+                dev.value_time = received
+                DISTANCE_READINGS.inc(dev.id, "accepted" if accepted else "rejected")
+                rtt = stats.received(dev.id, "distance", dev.value_time)
+                timeouts.observe((dev.id, "distance"), rtt)
+                if not retained:
+                    reading = (dev.value, dev.value_time)
             except:
                 pass
-            return
-        if topic == WATER["hb_resp"]:
-            heartbeats[WATER["id"]] = time.time()
-        
-        if topic == ACTUATOR["hb_resp"]:
-            heartbeats[ACTUATOR["id"]] = time.time()
-            print(f"RESPONSE: Actuator msg: {payload}")
-            print(f"RESPONSE: Actuator hbeat: {heartbeats[ACTUATOR['id']]}")
-            return
+        elif role == "hb_resp" and not retained:
+            record_heartbeat(dev, received)
+            applog.debug(log, "heartbeat", device=dev.id, payload=payload, time=dev.heartbeat)
+    if reading is not None:
+        # outside the state lock: a rule may command an actuator
+        rule_engine.on_event(topic, *reading)
 
 # client.on_message = on_message
 # client.connect(BROKER, PORT)
@@ -98,214 +304,636 @@ def on_message(client, userdata, message):
 # client.subscribe(subs)
 # client.loop_start()
 
+change_detector = ChangeDetector()
+# Only changed frames are archived, so a quiet scene may append nothing for
+# hours; the buffers are flushed from a timer instead of from append().
+ARCHIVE_FLUSH_INTERVAL = 2.0
+archive = ArchiveWriter(ARCHIVE_DIR, flush_interval=float("inf")) if ARCHIVE_DIR else None
+
+def flush_archive():
+    while True:
+        time.sleep(ARCHIVE_FLUSH_INTERVAL)
+        try:
+            archive.flush()
+        except OSError as e:
+            applog.warning(log, "archive flush failed", error=e)
+
+def process_frame(cam_id, payload, received):
+    # runs on a frame pipeline worker, not on the MQTT network thread
+    if not looks_like_jpeg(payload):
+        applog.warning(log, "invalid frame", device=cam_id, size=len(payload))
+        return False
+    changed, score = change_detector.check(cam_id, payload, received)
+    cam = devices[cam_id]
+    with lock:
+        if received < (cam.frame_time or 0):
+            return True  # a newer frame was already stored by the other worker
+        # An unchanged frame only refreshes the timestamp. Keeping the old
+        # bytes object lets the snapshot and shared store skip the copy.
+        if changed or cam.frame is None:
+            cam.frame = payload
+            cam.frame_change_time = received
+        cam.frame_time = received
+        req_t = cam.pic_request_time
+    if req_t is not None:
+        DEVICE_RTT.observe(received - req_t, cam_id, "picture")
+    rtt = stats.received(cam_id, "picture", received, size=len(payload))
+    timeouts.observe((cam_id, "picture"), rtt)
+    if changed and archive is not None:
+        archive.append(cam_id, received, payload)
+    applog.debug(log, "frame", device=cam_id, size=len(payload), changed=changed, score=score)
+    mark_changed()
+    return True
+
+reassembler = Reassembler()
+frames = FramePipeline("web_app_3", process_frame, workers=2, maxsize=len(CAMERAS) * 2)
+
+# Acks and readings are never dropped: a reading answers a request that
+# DeviceStats and the adaptive timeouts are waiting on, and feeds the
+# distance filter. When a queue is full the network thread waits.
+CONTROL_QUEUE = 256
+READING_QUEUE = 64
+control_lane = Lane("control", handle_queued, maxsize=CONTROL_QUEUE)
+reading_lane = Lane("reading", handle_queued, maxsize=READING_QUEUE)
+lanes = (control_lane, reading_lane)
+
+def bulk_subscriptions():
+    return [(cam["pic_resp"],1) for cam in CAMERAS.values()]
+
+def control_subscriptions():
+    return [(HB_RESP_WILDCARD, 1), (WATER["resp"],1)] + \
+           [(PUMP_RESP_TOPIC, 1), (LIGHT_RESP_TOPIC, 1)]
+
+def on_connect(client, userdata, flags, reason_code, properties):
+    # (re)subscribe on every connect; retained values arrive right after
+    subs = control_subscriptions()
+    if not SPLIT_CONNECTIONS:
+        subs = bulk_subscriptions() + subs
+    client.subscribe(subs)
+    applog.info(log, "mqtt connected", session_present=flags.session_present)
+    probe_all()
+
+def on_connect_bulk(client, userdata, flags, reason_code, properties):
+    client.subscribe(bulk_subscriptions())
+    applog.info(log, "mqtt bulk connected", session_present=flags.session_present)
+
+def probe_all():
+    # Fire every request at once instead of update_all's one-by-one waits;
+    # responses land in the state as they come in. This runs on the network
+    # thread and can't wait out a fleet window, so devices not yet known to
+    # answer the broadcast are pinged directly as well.
+    now = time.time()
+    with lock:
+        for dev in devices:
+            note_request(dev.id, "heartbeat", now)
+        for cam_id in CAMERAS:
+            note_request(cam_id, "picture", now)
+        note_request(WATER["id"], "distance", now)
+        direct = [dev for dev in devices if not dev.broadcast]
+    publish(FLEET_HB_REQ, "ping")
+    for dev in direct:
+        publish(dev.topics["hb_req"], "ping")
+    for cam in CAMERAS.values():
+        publish(cam["pic_req"], "get")
+    publish(WATER["req"], "get")
+
+def rule_timer():
+    # rules only run on readings, so readings are requested on a timer and
+    # the fail-safe (max on time, stale sensor) is checked on one too
+    next_poll = 0
+    while True:
+        now = time.time()
+        if now >= next_poll:
+            with lock:
+                note_request(water.id, "distance", now)
+            publish(WATER["req"], "get")
+            next_poll = now + RULE_POLL_INTERVAL
+        try:
+            rule_engine.check(now)
+        except Exception:
+            log.exception("rule check failed")
+        time.sleep(RULE_CHECK_INTERVAL)
+
 def init_mqtt():
-    global client
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    global client, bulk_client
+    start_snapshots()
+    outbox.start()
+    for lane in lanes:
+        lane.start()
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=CLIENT_ID, clean_session=False)
+    client.on_connect = on_connect
     client.on_message = on_message
     client.connect(BROKER, PORT)
-    subs = [(cam["pic_resp"],0) for cam in CAMERAS.values()] + \
-           [(cam["hb_resp"],0) for cam in CAMERAS.values()] + \
-           [(WATER["resp"],0), (WATER["hb_resp"],0)] + \
-           [(ACTUATOR["hb_resp"], 0)]
-
-    client.subscribe(subs)
+    if SPLIT_CONNECTIONS:
+        bulk_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"{CLIENT_ID}-bulk", clean_session=False)
+        bulk_client.on_connect = on_connect_bulk
+        bulk_client.on_message = on_message
+        bulk_client.connect(BROKER, PORT)
+        bulk_client.loop_start()
+    frames.start()
+    if archive is not None:
+        threading.Thread(target=flush_archive, daemon=True, name="archive-flush").start()
+        atexit.register(archive.close)
     client.loop_start()
+    actuator_engine.start()
+    if RULES_ENABLED:
+        threading.Thread(target=rule_timer, daemon=True, name="rules").start()
+
+# ================= SNAPSHOT =================
+
+# snapshot / shared store section -> Device attribute (the names predate the registry)
+STATE_FIELDS = (("images", "frame"), ("image_time", "frame_time"), ("image_change_time", "frame_change_time"),
+                ("heartbeats", "heartbeat"), ("hb_request_time", "hb_request_time"),
+                ("hb_timeout", "hb_timeout"))
+
+def export_state():
+    # frames are immutable bytes shared with the live state, nothing is copied
+    with lock:
+        state = {name: {} for name, _ in STATE_FIELDS}
+        for dev in devices:
+            for name, attr in STATE_FIELDS:
+                value = getattr(dev, attr)
+                if value is not None:
+                    state[name][dev.id] = value
+        state["water_value"] = water.value
+        state["water_raw"] = water.raw_value
+        state["water_time"] = water.value_time
+    state["actuators"] = {name: act["reported"] for name, act in actuator_engine.state().items()}
+    return state
+
+def restore_state(state):
+    # `state` may be partial (shared store updates); None removes an entry
+    with lock:
+        for name, attr in STATE_FIELDS:
+            for dev_id, value in state.get(name, {}).items():
+                dev = devices.get(dev_id)
+                if dev is not None:
+                    setattr(dev, attr, value)
+        if "water_value" in state:
+            water.value = state["water_value"]
+        if "water_raw" in state:
+            water.raw_value = state["water_raw"]
+        if "water_time" in state:
+            water.value_time = state["water_time"]
+    for name, reported in state.get("actuators", {}).items():
+        act = actuator_engine.actuators.get(name)
+        if act is not None and reported is not None:
+            act.desired = act.reported = int(reported)
+    state_view.changed()
+
+snapshotter = None
+
+def start_snapshots():
+    global snapshotter
+    if not SNAPSHOT_PATH or snapshotter is not None:
+        return
+    state = snapshot.load(SNAPSHOT_PATH)
+    if state:
+        # liveness isn't restored: a heartbeat that answered a request before
+        # the restart would show "ack" until the next probe
+        state.pop("hb_request_time", None)
+        restore_state(state)
+        applog.info(log, "snapshot restored", path=SNAPSHOT_PATH, images=sum(d.frame is not None for d in devices))
+    snapshotter = snapshot.Snapshotter(SNAPSHOT_PATH, export_state, SNAPSHOT_INTERVAL)
+    snapshotter.start()
+    atexit.register(snapshotter.stop)
+
+# ================= PROCESSES =================
+
+def require_authkey():
+    if not COMMAND_AUTHKEY:
+        raise SystemExit(f"WEB_APP_ROLE={ROLE} needs WEB_APP_AUTHKEY (the same secret for ingest and workers)")
+
+def init_ingest():
+    require_authkey()
+    init_mqtt()
+    store = shared_state.FrameStore(STORE_NAME, blob_slots=len(CAMERAS), blob_size=STORE_FRAME_SIZE, create=True)
+    atexit.register(store.close)
+    shared_state.StoreWriter(store, export_state, state_changed).start()
+    shared_state.CommandServer(COMMAND_ADDRESS, COMMAND_AUTHKEY, COMMANDS).start()
+
+def init_worker():
+    global command_client
+    require_authkey()
+    deadline = time.time() + STORE_WAIT
+    while True:
+        try:
+            store = shared_state.FrameStore(STORE_NAME)
+            break
+        except FileNotFoundError:
+            if time.time() >= deadline:
+                raise SystemExit(f"shared store {STORE_NAME!r} not found after {STORE_WAIT}s; "
+                                 f"start the ingest process (WEB_APP_ROLE=ingest) first")
+            time.sleep(0.5)
+    shared_state.StoreReader(store, restore_state).start()
+    command_client = shared_state.CommandClient(COMMAND_ADDRESS, COMMAND_AUTHKEY)
+
+def run_command(name, *args):
+    # anything that talks to devices runs where the MQTT client lives
+    if command_client is not None:
+        return command_client.call(name, *args)
+    return COMMANDS[name](*args)
 
 # ================= FLASK =================
 
 app = Flask(__name__)
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    g.span = profiler.span("http", request.endpoint)
+    g.span.__enter__()
+
+@app.teardown_request
+def end_span(exc):
+    span = g.pop("span", None)
+    if span is not None:
+        span.__exit__(None, None, None)
+
+@app.after_request
+def observe_latency(response):
+    start = g.get("start")
+    if start is not None:
+        HTTP_LATENCY.observe(time.perf_counter() - start, request.endpoint or "none", response.status_code)
+    return response
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/")
 def index():
-    return render_template("index_3.html", cams=list(CAMERAS.keys()))
+    # /?mosaic=1: one composed image instead of a request per camera (slow links)
+    return render_template("index_3.html", cams=list(CAMERAS.keys()),
+                           mosaic=request.args.get("mosaic") == "1")
 
 # ---------- CAMERA ----------
 @app.route("/camera/<cam_id>")
 def get_camera(cam_id):
+    cam = devices.get(cam_id)
     with lock:
-        if cam_id not in images:
-            return "No image", 404
-        return send_file(io.BytesIO(images[cam_id]), mimetype="image/jpeg")
+        frame = cam.frame if cam is not None else None
+    if frame is None:
+        return "No image", 404
+    FRAME_BYTES_SERVED.add(len(frame), cam_id)
+    return send_file(io.BytesIO(frame), mimetype="image/jpeg")
+
+@app.route("/cameras/mosaic")
+def get_mosaic():
+    # every camera in one downscaled JPEG; rebuilt only when a frame changed
+    jpeg, etag = mosaic.get()
+    if jpeg is None:
+        return "Mosaic failed", 500
+    FRAME_BYTES_SERVED.add(len(jpeg), "mosaic")
+    response = Response(jpeg, mimetype="image/jpeg")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+def mosaic_frames():
+    with lock:
+        return [(cam.id, cam.frame_change_time or cam.frame_time, cam.frame)
+                for cam in devices.of_kind("camera")]
+
+mosaic = Mosaic(mosaic_frames)
 
 # ---------- HEARTBEAT ----------
 @app.route("/heartbeat")
 def get_heartbeat():
-    now = time.time()
-    result = {}
     with lock:
-        # --- Cameras ---
-        for cam_id in CAMERAS:
-            ts = heartbeats.get(cam_id)            
-            req_t = hb_request_time.get(cam_id)
-            
-            # Skip if either is missing
-            if ts is None or req_t is None:
-                result[cam_id] = "offline"
-                continue
-
-            ts_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(ts))
-            
-            print(f"DEBUG: {cam_id} request time: {req_t:.3f}, response time: {ts:.3f} and diff: {(ts-req_t):.3f}s")
-
-            # result[cam_id] = "ack" if ts and now - ts < HEARTBEAT_TIMEOUT else "offline"
-            if (ts-req_t) < HEARTBEAT_TIMEOUT:
-                result[cam_id] = f"ack {ts_str}" 
-            else:
-                result[cam_id] = f"offline {ts_str}"
-        # ts = heartbeats.get(WATER["id"])
-        
-        # --- Water sensor ---
-        wl_id = WATER["id"]
-        res_wl = heartbeats.get(wl_id)
-        req_wl = hb_request_time.get(wl_id)
-
-        # Skip if either is missing
-        if res_wl is None or req_wl is None:
-            result[wl_id] = "offline"
-        else:
-            res_wl_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(res_wl))
-            print(f"DEBUG: {wl_id} request time: {req_wl:.3f}, response time: {res_wl:.3f} and diff: {(res_wl - req_wl):.3f}s")
-            if (res_wl - req_wl) < HEARTBEAT_TIMEOUT:
-                result[wl_id] = f"ack {res_wl_str}"
-            else:
-                result[wl_id] = f"offline {res_wl_str}"
+        result = {dev.id: heartbeat_status(dev) for dev in devices}
+    return jsonify(result)
 
-        # result[WATER["id"]] = "ack" if ts and now - ts < HEARTBEAT_TIMEOUT else "offline"
+def heartbeat_status(dev):
+    ts = dev.heartbeat
+    req_t = dev.hb_request_time
 
+    # Skip if either is missing
+    if ts is None or req_t is None:
+        return "offline"
 
+    ts_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(ts))
 
-        # --- Actuator ---
-        act_id = ACTUATOR["id"]
-        res_act = heartbeats.get(act_id)
-        req_act = hb_request_time.get(act_id)
-        # print(f"DEBUG:")
+    applog.debug(log, "heartbeat", device=dev.id, request=req_t, response=ts, diff=ts - req_t)
 
-        # Always show actuator status (default to offline if no data)
-        if res_act is None or req_act is None:
-            result[act_id] = "offline"
-        else:
-            act_rs_str = time.strftime("%H:%M:%S %d/%m/%Y", time.localtime(res_act))
-            print(f"DEBUG: {act_id} request time: {req_act:.3f}, response time: {res_act:.3f} and diff: {(res_act - req_act):.3f}s")
-            if (res_act - req_act) < HEARTBEAT_TIMEOUT:
-                result[act_id] = f"ack {act_rs_str}"
-            else:
-                result[act_id] = f"offline {act_rs_str}"
-
-    
-    print("HEARTBEAT ORDER:", list(result.keys()))
-    
-    return jsonify(result)
+    # a heartbeat from before the request (restored from a snapshot, or an
+    # answer to an earlier probe) doesn't answer it
+    timeout = dev.hb_timeout if dev.hb_timeout is not None else HEARTBEAT_TIMEOUT
+    if 0 <= ts - req_t < timeout:
+        return f"ack {ts_str}"
+    return f"offline {ts_str}"
+
+# ---------- STATE ----------
+@app.route("/state")
+def get_state():
+    # all devices in one response; ?since=<version>&epoch=<epoch> -> only what changed
+    state_view.start()
+    body = state_view.response(request.args.get("since", type=int), request.args.get("epoch"))
+    if body is None:
+        return "State not ready", 503
+    return Response(body, content_type="application/json")
+
+def build_state():
+    with lock:
+        out = {}
+        for dev in devices:
+            entry = {"kind": dev.kind, "heartbeat": heartbeat_status(dev)}
+            if dev.kind == "camera":
+                # the URL only changes with the scene, so unchanged frames stay cached
+                changed = dev.frame_change_time or dev.frame_time
+                entry["frame_time"] = dev.frame_time
+                entry["frame_url"] = f"/camera/{dev.id}?t={changed}" if dev.frame is not None else None
+            elif dev.kind == "water":
+                entry["value"] = round(dev.value, 2) if dev.value is not None else None
+                entry["raw"] = round(dev.raw_value, 2) if dev.raw_value is not None else None
+                entry["value_time"] = dev.value_time
+            out[dev.id] = entry
+    out[ACTUATOR["id"]]["actuators"] = actuator_engine.state()
+    return out
+
+state_view = StateView(build_state)
 
 # ---------- WATER ----------
 @app.route("/water")
 def get_water():
     with lock:
-        if water_value is None:
+        if water.value is None:
             return jsonify({"status": "no_data"})
-        return jsonify({"value": round(water_value,2)})
+        # value is filtered; raw is the last reading as received (may be a rejected spike)
+        raw = round(water.raw_value,2) if water.raw_value is not None else None
+        return jsonify({"value": round(water.value,2), "raw": raw})
 
 # ---------- ACTUATORS ----------
 
 @app.route("/pump/toggle", methods=["POST"])
 def toggle_pump():
-    global pump_state
-    pump_state = 0 if pump_state else 1
-    client.publish(PUMP_REQ_TOPIC, str(pump_state))
-    print("Pump state: ", pump_state)
-    return jsonify({"state": pump_state})
+    return jsonify(run_command("toggle", "pump"))
 
 @app.route("/light/toggle", methods=["POST"])
 def toggle_light():
-    global light_state
-    light_state = 0 if light_state else 1
-    client.publish(LIGHT_REQ_TOPIC, str(light_state))
-    print("Light state: ", light_state)
-    print(f"Publishing to {LIGHT_REQ_TOPIC}: {light_state}")
-    return jsonify({"state": light_state})
+    return jsonify(run_command("toggle", "light"))
 
-@app.route("/update_all")
-def update_all():
-    for cam_id, cam in CAMERAS.items():
-        # request heartbeat first
-        hb_request_time[cam_id] = time.time()
-        with lock:
-            heartbeats.pop(cam_id, None)  # ← clear old response
-        client.publish(cam["hb_req"], "ping")
-        start = time.time()
-        while time.time() - start < 4:
-            with lock:
-                if cam_id in heartbeats:
-                    break
-            time.sleep(0.1)
+@app.route("/actuators")
+def get_actuators():
+    # ?wait=<s> holds the request until pending commands are acked (max 5 s)
+    wait = request.args.get("wait", type=float)
+    return jsonify(run_command("actuators", wait))
 
-        time.sleep(0.2)
+def toggle_actuator(name):
+    # an operator's choice: the rules leave this actuator alone for a while
+    rule_engine.manual(name)
+    return actuator_engine.toggle(name)
+
+def actuator_state(wait=None):
+    if wait:
+        return actuator_engine.wait(min(wait, 5))
+    return actuator_engine.state()
 
+@app.route("/update_all")
+def update_all():
+    return jsonify(run_command("refresh"))
+
+# Every open dashboard calls /update_all on its own timer. One refresh runs
+# at a time: callers arriving while it runs wait for it and share its result,
+# and a refresh finished less than REFRESH_MIN_INTERVAL ago is served again.
+REFRESH_MIN_INTERVAL = 5  # s
+refresh_lock = threading.Lock()
+refresh_running = None    # threading.Event of the refresh in flight
+refresh_last = (0.0, None)  # (finished at, result)
+
+def refresh_all():
+    global refresh_running, refresh_last
+    with refresh_lock:
+        finished, result = refresh_last
+        if refresh_running is not None:
+            running, outcome = refresh_running, "shared"
+        elif result is not None and time.time() - finished < REFRESH_MIN_INTERVAL:
+            REFRESHES.inc("recent")
+            return result
+        else:
+            running = refresh_running = threading.Event()
+            outcome = "run"
+    REFRESHES.inc(outcome)
+    if outcome == "shared":
+        running.wait()
+        return refresh_last[1] or {"status": "failed"}
+    try:
+        result = run_refresh()
+        with refresh_lock:
+            refresh_last = (time.time(), result)
+        return result
+    finally:
+        with refresh_lock:
+            refresh_running = None
+        running.set()
+
+def run_refresh():
+    # liveness for the whole fleet first: one broadcast, one window
+    result = probe_fleet()
+
+    for cam in devices.of_kind("camera"):
         # request image
-        client.publish(cam["pic_req"], "get")
+        with lock:
+            requested = time.time()
+            note_request(cam.id, "picture", requested)
+        publish(cam.topics["pic_req"], "get")
 
         # wait only for THIS camera
-        start = time.time()
-        while time.time() - start < 4:
-            with lock:
-                if cam_id in images:
-                    break
-            time.sleep(0.1)
+        wait_for(cam.id, "picture", lambda: (cam.frame_time or 0) >= requested)
         time.sleep(0.2)
 
     # water sensor
-    hb_request_time[WATER["id"]] = time.time()
-    client.publish(WATER["hb_req"], "ping")
-    
-    # wait for heatbeat for water level sensor
-    start = time.time()
-    while time.time() - start < 4:
-        with lock:
-            if WATER["id"] in heartbeats:
-                break
-        time.sleep(0.1)
-
-    time.sleep(0.1)
-
+    # the filtered value is kept across refreshes; wait for a reading newer than the request
     with lock:
-        water_value = None # -> clear old value
-    client.publish(WATER["req"], "get")
+        requested = time.time()
+        note_request(water.id, "distance", requested)
+    publish(WATER["req"], "get")
 
     # wait for value of water level sensor
-    start = time.time()
-    while time.time() - start < 4:
-        with lock:
-            if water_value is not None:
-                break
-        time.sleep(0.1)
+    wait_for(water.id, "distance", lambda: (water.value_time or 0) >= requested)
 
-    # actuator sensor
-    hb_request_time[ACTUATOR["id"]] = time.time()
+    return {"status": "done", "heartbeat": result}
+
+def probe_fleet(window=None):
+    """Heartbeat every device with one publish to FLEET_HB_REQ and collect
+    the replies within one window. Devices known not to answer broadcasts
+    are pinged directly alongside it, and whoever is still silent after the
+    window gets one direct ping as a fallback. The answers teach each
+    device's `broadcast` flag for the next round."""
+    sent = time.time()
     with lock:
-            heartbeats.pop(ACTUATOR["id"], None)  # ← clear old response
-    
-    client.publish(ACTUATOR["hb_req"], "ping")
-    print(f"REQUEST: Actuator request time {hb_request_time[ACTUATOR['id']]}")
+        targets = list(devices)
+        for dev in targets:
+            note_request(dev.id, "heartbeat", sent)
+        direct = [dev for dev in targets if dev.broadcast is False]
+    publish(FLEET_HB_REQ, "ping")
+    for dev in direct:
+        publish(dev.topics["hb_req"], "ping")
+    if window is None:
+        window = max(timeouts.timeout((dev.id, "heartbeat")) for dev in targets)
+    missing = collect_heartbeats(targets, sent, window)
 
-    # wait for heatbeat for actuator
+    with lock:
+        for dev in targets:
+            if dev not in missing and dev.broadcast is None:
+                dev.broadcast = True
+    fallback = [dev for dev in missing if dev.broadcast is not False]
+    if fallback:
+        sent_direct = time.time()
+        with lock:
+            for dev in fallback:
+                # RTT from the direct ping, not from the broadcast window before it
+                note_request(dev.id, "heartbeat", sent_direct, restart=True)
+        for dev in fallback:
+            publish(dev.topics["hb_req"], "ping")
+        window = max(timeouts.timeout((dev.id, "heartbeat")) for dev in fallback)
+        missing = collect_heartbeats(missing, sent, window)
+        with lock:
+            for dev in fallback:
+                if dev not in missing:
+                    dev.broadcast = False
+    for dev in missing:
+        timeouts.timed_out((dev.id, "heartbeat"))
+
+    applog.info(log, "fleet heartbeat", devices=len(targets), direct=len(direct),
+                fallback=len(fallback), missing=len(missing))
+    return {"devices": len(targets), "answered": len(targets) - len(missing),
+            "fallback": len(fallback), "missing": [dev.id for dev in missing]}
+
+def collect_heartbeats(targets, since, window):
+    # -> the devices with no heartbeat newer than `since` after `window` s
+    deadline = time.time() + window
+    while True:
+        with lock:
+            missing = [dev for dev in targets if (dev.heartbeat or 0) < since]
+        if not missing or time.time() >= deadline:
+            return missing
+        time.sleep(0.05)
+
+def wait_for(dev_id, kind, done):
+    # poll until done() or this device's adaptive timeout; a miss backs it off
+    limit = timeouts.timeout((dev_id, kind))
     start = time.time()
-    while time.time() - start < 4:
+    while time.time() - start < limit:
         with lock:
-            if ACTUATOR["id"] in heartbeats:
-                break
-        time.sleep(0.1)
-    
-    return jsonify({"status": "done"})
+            if done():
+                return True
+        time.sleep(0.05)
+    timeouts.timed_out((dev_id, kind))
+    applog.info(log, "request timed out", device=dev_id, kind=kind, timeout=round(limit, 2))
+    return False
+
+@app.route("/heartbeat/probe", methods=["POST"])
+def heartbeat_probe():
+    return jsonify(run_command("probe"))
+
+# ---------- RULES ----------
+@app.route("/rules")
+def get_rules():
+    # thresholds, last decision and sensor-to-ack latency per rule
+    return jsonify(run_command("rules"))
+
+# ---------- STATS ----------
+@app.route("/stats")
+@app.route("/stats/<dev_id>")
+def get_stats(dev_id=None):
+    # ?window=<s> (default: the last hour)
+    window = request.args.get("window", type=float)
+    return jsonify(run_command("stats", dev_id, window))
 
 # ---------- MANUAL ----------
 @app.route("/manual", methods=["POST"])
 def manual():
-    data = request.json
-    req_topic = data["req"]
-    client.publish(req_topic, "get")
-    return jsonify({"status": "sent"})
+    data = request.get_json(silent=True) or {}
+    req_topic = data.get("req")
+    if req_topic not in MANUAL_TOPICS:
+        return jsonify({"status": "unknown_topic"}), 400
+    result = run_command("publish", req_topic)
+    if result["status"] == "rate_limited":
+        return jsonify(result), 429
+    if result["status"] == "unknown_topic":
+        return jsonify(result), 400
+    return jsonify(result)
+
+# only the "get"/"ping" request topics of known devices; anything else
+# (wildcards, actuator commands, typos) never reaches the publisher
+MANUAL_TOPICS = frozenset(topic for dev in devices for role, topic in dev.topics.items() if role.endswith("req"))
+
+def publish_manual(req_topic):
+    if req_topic not in MANUAL_TOPICS:
+        return {"status": "unknown_topic"}
+    status, entry = gate.request(req_topic, lambda: publish(req_topic, "get"))
+    if status == "rate_limited":
+        return {"status": status, "retry_after": round(entry, 2)}
+    return {"status": status}
+
+# ---------- ADMIN ----------
+@app.route("/admin/profile")
+def get_profile():
+    # samples every thread for ?seconds= (default 10, capped at
+    # profiler.MAX_SECONDS so the request finishes within gunicorn's --timeout)
+    # and answers with collapsed stacks for flamegraph.pl or speedscope;
+    # ?format=json gives span timings and the hottest lines instead.
+    # A worker profiles itself and, over the same window, the ingest process.
+    seconds = min(request.args.get("seconds", 10, type=float), profiler.MAX_SECONDS)
+    interval = request.args.get("interval", profiler.INTERVAL, type=float)
+    idle = request.args.get("idle") == "1"
+    try:
+        session = profiler.start(seconds, interval, idle)
+    except RuntimeError as e:
+        return str(e), 409
+    results = {}
+    if command_client is not None:
+        try:
+            results["ingest"] = command_client.call("profile", seconds, interval, idle, "ingest")
+        except (RuntimeError, EOFError, OSError) as e:
+            # ingest busy or gone: still answer with this worker's profile
+            applog.warning(log, "ingest profile failed", error=e)
+            results["ingest"] = {"collapsed": "", "summary": {"error": f"{type(e).__name__}: {e}"}}
+    session.wait()
+    prefix = f"worker-{os.getpid()}" if command_client is not None else None
+    results[prefix or ROLE] = profile_result(session, prefix)
+    if request.args.get("format") == "json":
+        return jsonify({name: result["summary"] for name, result in results.items()})
+    return Response("".join(result["collapsed"] for result in results.values()), content_type="text/plain")
+
+def run_profile(seconds, interval, idle, prefix=None):
+    session = profiler.start(seconds, interval, idle)
+    session.wait()
+    return profile_result(session, prefix)
+
+def profile_result(session, prefix=None):
+    return {"collapsed": session.collapsed(prefix), "summary": session.summary()}
+
+def device_summary(dev_id=None, window=None):
+    summary = stats.summary(dev_id, window)
+    for (dev, kind), value in timeouts.snapshot().items():
+        if dev_id is None or dev == dev_id:
+            summary.setdefault(dev, {}).setdefault(kind, {})["timeout"] = value
+    return summary
+
+COMMANDS = {
+    "toggle": toggle_actuator,
+    "actuators": actuator_state,
+    "refresh": refresh_all,
+    "probe": probe_fleet,
+    "publish": publish_manual,
+    "stats": device_summary,
+    "rules": rule_engine.summary,
+    "profile": run_profile,
+}
 
 # ================= MAIN =================
 
+def main():
+    if ROLE == "ingest":
+        init_ingest()
+        threading.Event().wait()
+    else:
+        init_mqtt()  # ← only run once, in main process
+        app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
+
 if __name__ == "__main__":
-    init_mqtt()  # ← only run once, in main process
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    main()
+elif ROLE == "worker":
+    init_worker()
\ No newline at end of file